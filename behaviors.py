@@ -1,31 +1,110 @@
+import os
 import sys
-import qi
 import time
 import select
 import signal
 import threading
-import json
 import random
+import traceback
 import math
-import numpy as np
-from PIL import Image
-from socket import socket, AF_INET, SOCK_STREAM
+import argparse
+import protocol
+import trajectory
+import latency
+import session_log
+import telemetry
+import poses
+import shm_channel
+from functools import partial
+from collections import deque
+from dispatch import Dispatcher, Runner, Task, Cancelled, Watchdog
+from joint_cache import JointStateCache
+from locomotion import LocomotionController
+from socket import socket, error, AF_INET, SOCK_STREAM, SOCK_DGRAM, SOL_SOCKET, SO_REUSEADDR
+
+POSES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "poses.json")
+
+# per-frame telemetry events, only every nth one is written
+TELEMETRY_SAMPLING = {"decider": 20, "locomote": 20, "busy": 20}
+
+BODY_JOINTS = ["HeadPitch", "HeadYaw",
+			   "LWristYaw", "LShoulderRoll", "LShoulderPitch", "LElbowRoll", "LElbowYaw", "LHand",
+			   "RWristYaw", "RShoulderRoll", "RShoulderPitch", "RElbowRoll", "RElbowYaw", "RHand",
+			   "HipPitch", "HipRoll", "KneePitch"]
+
+
+def resolve_services(session, names):
+	'''
+	Looks up naoqi services concurrently, each lookup is a round trip to the service directory.
+	'''
+	results = {}
+
+	def resolve(name):
+		try:
+			results[name] = session.service(name)
+		except Exception as e:
+			results[name] = e
+
+	threads = [threading.Thread(target=resolve, args=(name,)) for name in names]
+	for thread in threads:
+		thread.daemon = True		# Daemonize thread
+		thread.start()
+	for thread in threads:
+		thread.join()
+	for name in names:
+		if isinstance(results[name], Exception):
+			raise results[name]
+	return [results[name] for name in names]
 
 
 class Behaviors:
 
-	def __init__(self):
-		self.conn_lock = threading.Lock()
-		self.session = qi.Session()
-		self.session.connect("tcp://{}:9559".format(sys.argv[1]))
+	def __init__(self, ip, session=None, show_image=True, record=None, accel=(0.8, 2.0), decel=(1.6, 4.0), pose_file=POSES,
+				 telemetry_level=telemetry.INFO, dump_seconds=5.0, shm=True):
+		'''
+		session -- a connected qi.Session, or a stand-in such as fake_naoqi.Session.
+		By default connects to naoqi on ip.
+		record -- path of a session log that every received frame is appended to, see session_log.py
+		accel, decel -- base acceleration limits, (m/s^2, rad/s^2), see locomotion.py
+		pose_file -- postures, arm and head poses, see poses.py
+		telemetry_level -- lowest level written to stdout, see telemetry.py
+		dump_seconds -- history written after an emergency stop, at every level, 0 for none
+		shm -- offer the shared-memory channel to clients on this host, see shm_channel.py
+		'''
+		self.telemetry = telemetry.Telemetry(telemetry_level, sample=TELEMETRY_SAMPLING)
+		self.dump_seconds = dump_seconds
+		# startup phases, printed once the robot is warmed up
+		self.startup = latency.PhaseTimer("startup")
+		self.host = ip
+		with self.startup.phase("poses"):
+			self.poses = poses.load(BODY_JOINTS, pose_file)
+		if session is None:
+			with self.startup.phase("connect"):
+				import qi
+				session = qi.Session()
+				session.connect("tcp://{}:9559".format(ip))
+		self.session = session
 		self.s = None
 		self.conn = None
-		self.tts_service = self.session.service("ALTextToSpeech")
-		self.animated_tts_service = self.session.service("ALAnimatedSpeech")
-		self.motion_service = self.session.service("ALMotion")
-		self.posture_service = self.session.service("ALRobotPosture")
-		self.led_service = self.session.service("ALLeds")
-		self.al_service = self.session.service("ALAutonomousLife")
+		self.client_addr = None
+		# UDP axes channel, see protocol.py
+		self.udp = None
+		self.udp_active = False
+		self.udp_seq = None
+		self.udp_axes = None
+		self.udp_received_at = None
+		self.udp_stale = 0
+		# shared-memory channel of a client on this host, polled by its own thread
+		self.allow_shm = shm
+		self.shm = None
+		self.shm_thread = None
+		self.shm_axes = None
+		# replies come from the receiving thread and the shared-memory thread
+		self.send_lock = threading.Lock()
+		with self.startup.phase("services"):
+			(self.tts_service, self.animated_tts_service, self.motion_service, self.posture_service,
+			 self.led_service, self.al_service) = resolve_services(self.session, [
+				"ALTextToSpeech", "ALAnimatedSpeech", "ALMotion", "ALRobotPosture", "ALLeds", "ALAutonomousLife"])
 
 		self.animation_dict = {
 			"Thinking": ["BodyTalk/Thinking/Remember_4", "BodyTalk/Thinking/ThinkingLoop_1", "Thinking/ThinkingLoop_2"],
@@ -45,80 +124,332 @@ class Behaviors:
 		self.head_pitch = "PitchStraight"
 		self.head_yaw = "YawStraight"
 		self.resting = False
-		self.moving = False
 		self.locked = False
-		if self.al_service.getState() != "disabled":
-			self.motion_service.rest()
-			self.al_service.setState("disabled")
-			self.motion_service.wakeUp()
-		if self.motion_service.getStiffnesses('Head')[0] == 0:
-			self.motion_service.wakeUp()
-		self.motion_service.setBreathEnabled('Body', self.breathing)
-		self.set_global_volume(0)
-		
-		self.motion_service.setStiffnesses('Head', .4)
-		self.motion_service.setStiffnesses('LArm', .4)
-		self.motion_service.setStiffnesses('RArm', .4)
-		self.motion_service.setStiffnesses('Leg', .4)
 
 		# locks
 		self.behavior_lock = threading.Lock()
 		self.locked_lock = threading.Lock()
+		# set by warm_up, which then releases the frames held by the dispatcher
+		self.ready = threading.Event()
+
+		# latency stages of a frame: gamepad event to send (measured by the client),
+		# arrival to dispatch, and dispatch until the first ALMotion.move towards it returns
+		self.latency_stages = [
+			("input->wire", latency.RollingHistogram()),
+			("wire->dispatch", latency.RollingHistogram()),
+			("dispatch->move", latency.RollingHistogram()),
+		]
+		self.latency = dict(self.latency_stages)
+		self.dispatch_started = None
+
+		# worker threads
+		# held until the robot is warmed up, an emergency stop is dispatched at once
+		self.dispatcher = Dispatcher(self.dispatch, histogram=self.latency["wire->dispatch"],
+									 output=partial(self.telemetry.info, "stats", "{}"), held=True)
+		self.behavior_runner = Runner()
+		# ramps the base towards the joystick at 50 Hz, calling move only on a real change
+		self.locomotion = LocomotionController(lambda forward, yaw: self.motion_service.move(forward, 0, yaw),
+											   accel=accel, decel=decel, histogram=self.latency["dispatch->move"])
+		self.current_task = None
+		# stop driving after ~3 missed frames, whatever the socket is doing
+		self.watchdog = Watchdog(protocol.WATCHDOG_DEADLINE, self.frames_missed)
+		# sampled at 50 Hz, reads older than 50 ms go to the robot
+		self.joint_cache = JointStateCache(self.motion_service, BODY_JOINTS, rate=50.0, max_age=0.05)
 
 		# latency
 		self.msg_timestamp = None
+		self.stop_latencies = deque(maxlen=100)
+
+		# trajectories: fewest keyframes per joint that stay within this many radians
+		# of the full 100-keyframe profile. None always sends all 100 keyframes.
+		self.keyframe_deviation = math.radians(0.2)
+
+		# button presses of PROTOCOL_EVENTS clients, each delivered once across reconnects
+		self.presses = protocol.PressFilter()
+
+		# record and replay
+		self.session_log = session_log.SessionLog(record) if record else None
 
 		# display the image!
-		im = Image.open("img/AWF.png")
-		im.show()
+		if show_image:
+			thread = threading.Thread(target=self.display_image)
+			thread.daemon = True		# Daemonize thread
+			thread.start()
+
+		# the listener can come up while the robot warms up
+		thread = threading.Thread(target=self.warm_up)
+		thread.daemon = True		# Daemonize thread
+		thread.start()
+		self.startup.mark("constructed")
+
+	def warm_up(self, attempts=3, retry_delay=2.0):
+		'''
+		Prepares the robot, retrying a failed attempt. A server that cannot act on
+		frames exits rather than keep accepting clients.
+		'''
+		for attempt in range(1, attempts + 1):
+			try:
+				with self.startup.phase("autonomous life"):
+					if self.al_service.getState() != "disabled":
+						self.motion_service.rest()
+						self.al_service.setState("disabled")
+						self.motion_service.wakeUp()
+				with self.startup.phase("wake up"):
+					if self.motion_service.getStiffnesses('Head')[0] == 0:
+						self.motion_service.wakeUp()
+				with self.startup.phase("settings"):
+					self.motion_service.setBreathEnabled('Body', self.breathing)
+					self.set_global_volume(0)
+					self.motion_service.setStiffnesses(['Head', 'LArm', 'RArm', 'Leg'], .4)
+				break
+			except Exception:
+				print("Error encountered during robot warm-up (attempt {} of {}).".format(attempt, attempts))
+				traceback.print_exc()
+				if attempt < attempts:
+					time.sleep(retry_delay)
+		else:
+			print("Unable to warm up the robot, exiting.")
+			self.telemetry.drain()
+			sys.stdout.flush()
+			os._exit(1)
+		self.ready.set()
+		self.dispatcher.release()
+		self.startup.mark("ready")
+		print(self.startup.report())
+
+	def display_image(self):
+		with self.startup.phase("image"):
+			from PIL import Image
+			im = Image.open("img/AWF.png")
+			im.show()
 
 	def signal_handler(self, sig, frame):
 		self.s.close()
+		self.close_shm()
 		self.stop_and_lock()
+		if self.session_log is not None:
+			self.session_log.close()
+		# write what the telemetry writer has not, including the stop's dump
+		self.telemetry.drain()
 		print("exiting")
 		sys.exit(0)
 
+	def latency_report(self, sig=None, frame=None):
+		print(latency.report(self.latency_stages))
+		# call statistics when running against fake_naoqi
+		if hasattr(self.session, "report"):
+			print(self.session.report())
+
 	def connection_manager(self):
+		thread = threading.Thread(target=self.serve)
+		thread.daemon = True		# Daemonize thread
+		thread.start()
+		# keep the main thread free to run the SIGINT handler
+		while True:
+			time.sleep(1.0)
+
+	def serve(self):
 		'''
-		Intermittently check whether a connection is open
+		Serve one client at a time from a single listening socket. A new client is
+		accepted as soon as the previous connection ends.
 		'''
+		self.s = self.listen()
+		self.startup.mark("listening")
+		self.udp = self.listen_udp()
+		if self.udp is not None:
+			thread = threading.Thread(target=self.receive_udp)
+			thread.daemon = True		# Daemonize thread
+			thread.start()
+		disconnected_at = None
 		while True:
-			time.sleep(2.0)
-			if self.conn_lock.acquire(False):
-				print("Attempting connection...")
-				self.conn_lock.release()
-				self.s = socket(AF_INET, SOCK_STREAM)
-				self.conn = None
-				thread = threading.Thread(target=self.connect_and_listen_wrapper)
-				thread.daemon = True		# Daemonize thread
-				thread.start()
-			else:
-				pass
+			self.conn, addr = self.s.accept()  # accepts the connection
+			protocol.tune_socket(self.conn)
+			self.client_addr = addr
+			print("Connected to: ", addr)  # prints the connection
+			if disconnected_at is not None:
+				print("Reconnected after {:.0f} ms.".format(1000 * (time.time() - disconnected_at)))
+			disconnected_at = self.connect_and_listen_wrapper()
+
+	def listen(self):
+		s = socket(AF_INET, SOCK_STREAM)
+		s.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+		while True:
+			try:
+				s.bind((self.host, 8888))
+				break
+			except error:
+				print("Unable to bind to {}:8888. Retrying...".format(self.host))
+				time.sleep(1)
+		s.listen(1)
+		print("Listening on {}:8888".format(self.host))
+		return s
+
+	def listen_udp(self):
+		s = socket(AF_INET, SOCK_DGRAM)
+		try:
+			s.bind((self.host, protocol.UDP_PORT))
+		except error:
+			print("Unable to bind UDP port {}, axes will only be received over TCP.".format(protocol.UDP_PORT))
+			s.close()
+			return None
+		return s
+
+	def receive_udp(self):
+		'''
+		Feeds axes datagrams from the connected client to the dispatcher, dropping any that arrive out of order.
+		'''
+		while True:
+			data, addr = self.udp.recvfrom(64)
+			received_at = time.time()
+			if not self.udp_active or self.client_addr is None or addr[0] != self.client_addr[0]:
+				continue
+			try:
+				seq, _, velocity, twist = protocol.decode_axes(data)
+			except ValueError:
+				continue
+			if not protocol.seq_newer(seq, self.udp_seq):
+				self.udp_stale += 1
+				continue
+			self.udp_seq = seq
+			self.udp_received_at = received_at
+			self.udp_axes = {"velocity": velocity, "twist": twist}
+			ev = protocol.empty_ev()
+			ev.update(self.udp_axes)
+			self.feed_watchdog(ev, received_at)
+			self.dispatcher.submit(ev, received_at)
+
+	def start_shm(self, hello, wire_protocol):
+		'''
+		Opens the shared-memory channel if the client asked for it and runs on this host.
+		'''
+		self.close_shm()
+		if not (self.allow_shm and protocol.wants_shm(hello) and wire_protocol >= protocol.PROTOCOL_EVENTS
+				and shm_channel.is_loopback(self.client_addr[0])):
+			return
+		try:
+			self.shm = shm_channel.ShmChannel.create()
+		except EnvironmentError as e:
+			print("Unable to create the shared-memory channel ({}), axes will be received over TCP.".format(e))
+			return
+		self.shm_thread = threading.Thread(target=self.receive_shm, args=(self.shm,))
+		self.shm_thread.daemon = True		# Daemonize thread
+		self.shm_thread.start()
+
+	def close_shm(self):
+		channel, self.shm = self.shm, None
+		if channel is None:
+			return
+		self.shm_thread.join()
+		channel.close()
+		self.shm_axes = None
+
+	def receive_shm(self, channel):
+		'''
+		Polls the shared-memory channel until it is closed. New axes and presses go to
+		the dispatcher like frames, presses are acknowledged over TCP.
+		'''
+		version = 0  # not written yet
+		while self.shm is channel:
+			time.sleep(shm_channel.POLL_INTERVAL)
+			received_at = time.time()
+			try:
+				update = channel.read_axes(version)
+				presses = channel.pop_presses()
+				batch = []
+				if update is not None:
+					version, (seq, stamp, velocity, twist, input_age) = update
+					self.shm_axes = {"velocity": velocity, "twist": twist}
+					if input_age is not None:
+						self.latency["input->wire"].record(input_age, received_at)
+					ev = protocol.empty_ev()
+					ev.update(self.shm_axes)
+					if self.session_log is not None:
+						self.session_log.write(ev, seq, stamp, input_age, received_at)
+					self.feed_watchdog(ev, received_at)
+					batch.append(ev)
+				acked = False
+				for press in presses:
+					try:
+						ev = self.press_event(press, self.shm_axes or {"velocity": 0.0, "twist": 0.0}, received_at)
+					except ValueError:
+						self.telemetry.warning("receive", "Dropping malformed press.")
+						continue
+					acked = True
+					if ev is not None:
+						batch.append(ev)
+				self.dispatcher.submit_many(batch, received_at)
+				if acked:
+					self.ack_presses()
+			except Exception:
+				print("Error encountered when reading shared memory.")
+				traceback.print_exc()
+				break
+
+	def channel_axes(self, now):
+		'''
+		Axes of the UDP or shared-memory channel, which override those of TCP frames. None if neither is up.
+		UDP axes older than the watchdog deadline count as absent, so TCP frames drive (and feed the
+		watchdog) again once the datagrams stop, instead of reviving the last UDP velocity.
+		'''
+		if self.shm is not None and self.shm_axes is not None:
+			return self.shm_axes
+		if (self.udp_active and self.udp_axes is not None
+				and now - self.udp_received_at < protocol.WATCHDOG_DEADLINE):
+			return self.udp_axes
+		return None
+
+	def send_reply(self, data):
+		with self.send_lock:
+			self.conn.send(data)
+
+	def feed_watchdog(self, ev, received_at):
+		'''
+		Arms the watchdog only while the axes drive the base. An idle client just sends heartbeats.
+		'''
+		if ev["velocity"] or ev["twist"]:
+			self.watchdog.feed(received_at)
+		else:
+			self.watchdog.disarm()
 
 	def connect_and_listen_wrapper(self):
-		"""Wrap everything in a try-except to ensure that any errors cause the robot to stop."""
+		"""Wrap everything in a try-except to ensure that any errors cause the robot to stop.
+		Returns when the connection ended, i.e. before the robot was stopped."""
 		try:
 			self.connect_and_listen()
 		except:
 			print("Error encountered. Bringing robot to full stop.")
+		disconnected_at = time.time()
+		self.close_shm()
+		self.watchdog.disarm()
+		if self.udp_active:
+			print("udp: {} stale datagrams discarded".format(self.udp_stale))
+		self.udp_active = False
 		self.stop_and_lock()
-		self.s.close()
+		self.conn.close()
 		self.conn = None
+		self.client_addr = None
+		if self.session_log is not None:
+			self.session_log.flush()
+		self.dispatcher.flush_report()
+		print(self.watchdog.report())
+		print(self.presses.report())
+		print(self.joint_cache.report())
+		print(self.locomotion.report())
+		print(self.telemetry.report())
+		self.latency_report()
+		if self.stop_latencies:
+			print("stop to still: {} stops, mean {:.0f} ms max {:.0f} ms".format(
+				len(self.stop_latencies), 1000 * sum(self.stop_latencies) / len(self.stop_latencies), 1000 * max(self.stop_latencies)))
 		print("Connection closed.")
-		self.conn_lock.release()
+		return disconnected_at
 
 	def connect_and_listen(self):
-		self.conn_lock.acquire()
-		while True:
-			try:
-				self.s.bind((sys.argv[1], 8888))
-				self.s.listen(1)
-				self.conn, addr = self.s.accept()  # accepts the connection
-				print("Connected to: ", addr)  # prints the connection
-				break
-			except:
-				print("Unable to connect to client. Retrying...")
-				time.sleep(1)
+		# arrival of the last frame, bytes that frame nothing do not count
+		self.msg_timestamp = time.time()
+		self.udp_seq = None
+		self.udp_axes = None
+		self.udp_received_at = None
+		self.udp_stale = 0
 
 		# Key:
 		# 
@@ -148,30 +479,114 @@ class Behaviors:
 		# OPTIONS
 		# left joy button = breath on/off
 		# right joy button = mute on/off
-		cutoff = b''
+		framer = protocol.Framer()
+		negotiated = framer.protocol
+		# axes of the newest frame, carried by press events so they do not stop the base
+		axes = {"velocity": 0.0, "twist": 0.0}
 		while True:
 			try:
 				read_s, _, _ = select.select([self.conn], [], [])
 				msg_timestamp = time.time()
-				if self.msg_timestamp is not None and msg_timestamp - self.msg_timestamp > 2.0:
-					print("High latency detected.")
-					self.msg_timestamp = None
+				if msg_timestamp - self.msg_timestamp > protocol.SILENCE_TIMEOUT:
+					self.telemetry.warning("receive", "No frame for {:.1f} s, dropping the connection.", msg_timestamp - self.msg_timestamp)
 					break
-				self.msg_timestamp = msg_timestamp
-				data_bytes = cutoff + read_s[0].recv(2048)  # receiving data
-				cutoff = b''
-				all_str = [d for d in data_bytes.decode().split("\n") if len(d) > 0]
-				data_str = [d for d in all_str if d[0] == "{" and d[-1] == "}"]
-				if len(all_str) > 0 and "}" not in all_str[-1] and "{" in all_str[-1]:
-					cutoff = all_str[-1]
-				data = json.loads(data_str[-1])
+				if framer.recv_from(read_s[0]) == 0:  # receiving data
+					print("Client closed the connection.")
+					break
+				batch = []
+				acked = False
+				for frame in framer.frames():
+					self.msg_timestamp = msg_timestamp
+					if framer.protocol >= protocol.PROTOCOL_STAMPED and protocol.message_type(frame) != protocol.FRAME_MAGIC:
+						if protocol.message_type(frame) == protocol.PING_MAGIC:
+							self.send_reply(protocol.encode_pong(frame, time.time()))
+						elif protocol.message_type(frame) == protocol.PRESS_MAGIC:
+							try:
+								press = self.press_event(frame, axes, msg_timestamp)
+							except ValueError:
+								self.telemetry.warning("receive", "Dropping malformed press.")
+								continue
+							# acknowledged even if it is a duplicate, so the client stops resending it
+							acked = True
+							if press is not None:
+								batch.append(press)
+						continue
+					try:
+						seq, stamp, data, input_age = protocol.decode_frame(framer.protocol, frame)
+					except ValueError:
+						self.telemetry.warning("receive", "Dropping malformed frame.")
+						continue
+					if input_age is not None:
+						self.latency["input->wire"].record(input_age, msg_timestamp)
+					if protocol.is_hello(data):
+						framer.switch(protocol.choose_protocol(data))
+						negotiated = framer.protocol
+						self.udp_active = protocol.wants_udp(data) and self.udp is not None
+						self.presses.start(protocol.client_session(data))
+						self.start_shm(data, framer.protocol)
+						udp_port = protocol.UDP_PORT if self.udp_active else None
+						shm_path = self.shm.path if self.shm is not None else None
+						self.send_reply(protocol.accept(framer.protocol, udp_port, shm_path))
+						print("Negotiated wire protocol {}{}{}".format(framer.protocol, " with UDP axes" if self.udp_active else "",
+																	 " with shared memory" if self.shm is not None else ""))
+						continue
+					if framer.protocol >= protocol.PROTOCOL_EVENTS:
+						# buttons arrive as press events, the frame bits are only the held state
+						for name in protocol.BUTTONS:
+							data[name] = 0
+					channel_axes = self.channel_axes(msg_timestamp)
+					if channel_axes is not None:
+						# the UDP or shared-memory channel is the authority on the axes
+						data.update(channel_axes)
+					axes = {"velocity": data["velocity"], "twist": data["twist"]}
+					if self.session_log is not None:
+						self.session_log.write(data, seq, stamp, input_age, msg_timestamp)
+					batch.append(data)
+				if negotiated != framer.protocol:
+					# the client gave up waiting for the accept and speaks JSON, without the side channels
+					self.telemetry.warning("receive", "Client fell back to wire protocol {}.", framer.protocol)
+					negotiated = framer.protocol
+					self.close_shm()
+					self.udp_active = False
+				if batch and self.channel_axes(msg_timestamp) is None:
+					self.feed_watchdog(batch[-1], msg_timestamp)
+				self.dispatcher.submit_many(batch, msg_timestamp)
+				if acked:
+					self.ack_presses()
 			except:
 				print("Error encountered when receiving data.")
 				break
 
-			thread = threading.Thread(target=self.behavior_decider, args=(data,))
-			thread.daemon = True		# Daemonize thread
-			thread.start()	
+	def press_event(self, frame, axes, received_at):
+		'''
+		Turns a press message into a frame for the dispatcher, or None if the press was seen before.
+		Raises ValueError on a malformed press.
+		'''
+		press_id, button, _ = protocol.decode_press(frame)
+		if not self.presses.accept(press_id):
+			return None
+		ev = protocol.empty_ev()
+		ev.update(self.channel_axes(received_at) or axes)
+		ev[button] = 1
+		if self.session_log is not None:
+			self.session_log.write(ev, None, None, None, received_at)
+		return ev
+
+	def ack_presses(self):
+		'''
+		Acknowledges every press up to the newest one delivered. Until one was, there is nothing to acknowledge.
+		'''
+		if self.presses.last_id is not None:
+			self.send_reply(protocol.encode_ack(self.presses.last_id))
+
+	def dispatch(self, ev):
+		self.dispatch_started = time.time()
+		self.behavior_decider(ev)
+
+	def frames_missed(self):
+		if self.locomotion.moving():
+			self.locomotion.stop()
+			self.telemetry.warning("watchdog", "No frames for {:.0f} ms, stopped locomotion.", self.watchdog.deadline * 1000)
 
 	def behavior_decider(self, ev):
 		# return if locked
@@ -185,19 +600,19 @@ class Behaviors:
 			if self.behavior_lock.acquire(False):  # non-blocking
 				# the only command that we can recognize is "standing"
 				if ev["a"]:
-					self.motion_service.wakeUp()
-					self.resting = False
-				elif sum(list(ev.values())) > 0:
-					print("Can not execute non-wakeUp behavior when robot is resting.")
-				self.behavior_lock.release()
+					self.start_behavior(self.wake_up)
+				else:
+					if sum(list(ev.values())) > 0:
+						self.telemetry.info("busy", "Can not execute non-wakeUp behavior when robot is resting.")
+					self.behavior_lock.release()
 			elif sum(list(ev.values())) > 0:
-				print("Can not execute new behavior as another behavior is still executing!")
+				self.telemetry.info("busy", "Can not execute new behavior as another behavior is still executing!")
 
 		else:
 			# ALWAYS update the velocity, twist, and emergency stop/lock/unlock
 			forward = ev["velocity"] * 0.4
 			twist = ev["twist"] * 0.6
-			print(forward)
+			self.telemetry.debug("decider", "forward {:.3f} twist {:.3f}", forward, twist)
 			stop_and_lock = ev["info"]
 			self.locomote(forward, twist)
 			if stop_and_lock:
@@ -213,59 +628,138 @@ class Behaviors:
 					self.toggle_mute()
 
 				# ONLY one behavior can run at a time from here on
+				behavior = None
 				# meta behaviors
 				if ev["lb"]:
-					self.say_whats_next()
+					behavior = self.say_whats_next
 				elif ev["rb"]:
-					self.thank_you()
+					behavior = self.thank_you
 				elif ev["center"]:
-					self.motion_aloha()
+					behavior = self.motion_aloha
 
 				# posture
 				elif ev["a"]:
-					self.posture({"position": "Standing", "duration": 4.0})
+					behavior = partial(self.posture, {"position": "Standing", "duration": 4.0})
 				elif ev["b"]:
 					self.resting = True
-					# self.posture({"position": "Resting", "duration": 4.0})
-					self.motion_service.rest()
+					# behavior = partial(self.posture, {"position": "Resting", "duration": 4.0})
+					behavior = self.rest
 				elif ev["x"]:
-					self.posture({"position": "Welcoming", "duration": 4.0})
+					behavior = partial(self.posture, {"position": "Welcoming", "duration": 4.0})
 				elif ev["y"]:
-					self.posture({"position": "Hands on hips", "duration": 4.0})
+					behavior = partial(self.posture, {"position": "Hands on hips", "duration": 4.0})
 
 				# head
 				elif ev["up"]:
-					self.head({"position": "up", "duration": 2.0})
+					behavior = partial(self.head, {"position": "up", "duration": 2.0})
 				elif ev["down"]:
-					self.head({"position": "down", "duration": 2.0})
+					behavior = partial(self.head, {"position": "down", "duration": 2.0})
 				elif ev["left"]:
-					self.head({"position": "left", "duration": 2.0})
+					behavior = partial(self.head, {"position": "left", "duration": 2.0})
 				elif ev["right"]:
-					self.head({"position": "right", "duration": 2.0})
+					behavior = partial(self.head, {"position": "right", "duration": 2.0})
 
-				self.behavior_lock.release()
+				if behavior is None:
+					self.behavior_lock.release()
+				else:
+					self.start_behavior(behavior)
 			elif sum(list(ev.values())) > 0:
-				print("Can not execute new behavior as another behavior is still executing!")
+				self.telemetry.info("busy", "Can not execute new behavior as another behavior is still executing!")
+
+	def start_behavior(self, behavior):
+		'''
+		Runs behavior as a cancellable task on the behavior thread. The caller must
+		hold behavior_lock, which is released once the behavior returns.
+		'''
+		task = Task(getattr(getattr(behavior, "func", behavior), "__name__", "behavior"))
+		self.current_task = task
+		self.behavior_runner.submit(self.run_behavior, task, behavior)
+
+	def run_behavior(self, task, behavior):
+		task.thread = threading.current_thread()
+		try:
+			behavior()
+		except Cancelled:
+			self.telemetry.info("behavior", "Behavior {} ({}) cancelled after {:.0f} ms.", task.name, task.id, 1000 * (time.time() - task.cancelled_at))
+		finally:
+			self.current_task = None
+			self.behavior_lock.release()
+
+	def running_task(self):
+		'''
+		The task being executed by the calling thread, if any.
+		'''
+		task = self.current_task
+		if task is not None and task.thread is threading.current_thread():
+			return task
+		return None
+
+	def wait_for(self, future):
+		'''
+		Blocks on a qi.Future. Inside a behavior, raises Cancelled as soon as the behavior is cancelled.
+		'''
+		task = self.running_task()
+		if task is None:
+			return future.value()
+		return task.wait(future)
+
+	def cancel_behavior(self):
+		task = self.current_task
+		if task is not None:
+			task.cancel()
 
 	###########################
 	# Behavior Implementations
 	###########################
 	def stop_and_lock(self):
 		self.locked_lock.acquire()
+		stop_start = time.time()
 		# stop everything immediately!
-		self.locomote(0, 0)
+		self.locomotion.stop()
+		self.telemetry.warning("estop", "Emergency stop.")
+		self.cancel_behavior()
+		self.motion_service.killTasksUsingResources(BODY_JOINTS)
 		self.tts_service.stopAll()
-		names = ["HeadPitch", "HeadYaw",
-				 "LWristYaw", "LShoulderRoll", "LShoulderPitch", "LElbowRoll", "LElbowYaw", "LHand",
-				 "RWristYaw", "RShoulderRoll", "RShoulderPitch", "RElbowRoll", "RElbowYaw", "RHand",
-				 "HipPitch", "HipRoll", "KneePitch"]
-		curr_angles = self.motion_service.getAngles(names, True)
+		names = BODY_JOINTS
+		# a sample older than 10 ms would pull a fast-moving body back, read the robot instead
+		curr_angles = self.joint_cache.get(names, max_age=0.01)
 		self.motion_service.setAngles(names, curr_angles, 0.1)
-		self.set_stiffness(0.6, "Body")
+		thread = threading.Thread(target=self.measure_stop, args=(stop_start,))
+		thread.daemon = True		# Daemonize thread
+		thread.start()
+		# not waited for, the body already holds still and the next client should not wait a second
+		self.motion_service.stiffnessInterpolation("Body", 0.6, 1.0, _async=True)
 		self.locked = True
-		print("Emergency stop and lock. You must unlock the robot to continue using it.")
+		self.telemetry.warning("estop", "Stopped and locked in {:.0f} ms. You must unlock the robot to continue using it.",
+							   1000 * (time.time() - stop_start))
+		self.telemetry.count("emergency stops")
+		if self.dump_seconds > 0:
+			self.telemetry.request_dump(self.dump_seconds)
 		self.locked_lock.release()
 
+	def measure_stop(self, stop_start, threshold=0.002, timeout=3.0):
+		'''
+		Records how long the body takes to come to rest after an emergency stop:
+		the time until no joint moves more than threshold radians between two 20 ms samples.
+		'''
+		prev = self.joint_cache.get(BODY_JOINTS, fresh=True)
+		while time.time() - stop_start < timeout:
+			time.sleep(0.02)
+			curr = self.joint_cache.get(BODY_JOINTS, fresh=True)
+			if max(abs(a - b) for a, b in zip(curr, prev)) < threshold:
+				break
+			prev = curr
+		latency = time.time() - stop_start
+		self.stop_latencies.append(latency)
+		self.telemetry.info("estop", "Stop to still: {:.0f} ms", 1000 * latency)
+
+	def wake_up(self):
+		self.wait_for(self.motion_service.wakeUp(_async=True))
+		self.resting = False
+
+	def rest(self):
+		self.wait_for(self.motion_service.rest(_async=True))
+
 	def unlock(self):
 		print("unlocking robot...")
 		self.locked_lock.acquire()
@@ -290,10 +784,11 @@ class Behaviors:
 		self.say({"speech": "Thank you for seeing the potential in robots like me.", "volume": 200, "pitch": 100, "speed": 80, "animation": "Bowing"})
 
 	def motion_aloha(self):
-		thread = threading.Thread(target=self.head_animation)
-		thread.daemon = True		# Daemonize thread
-		thread.start()
+		# head and left arm joints are disjoint, so both animations run at once
+		head = self.head_animation(wait=False)
 		self.wave_animation()
+		self.wait_for(head)
+		print("Finished head animation.")
 
 	def toggle_breath(self):
 		if self.breathing:
@@ -316,44 +811,15 @@ class Behaviors:
 
 	def arm(self, params):
 		'''
-		"Left Extended": 
-		"Right Extended":
-		"Left Retracted":
-		"Right Retracted":
-		"Left Open":
-		"Right Open",:
-		"Left Grasping":
-		"Right Grasping:
+		position -- an "arm" pose from the pose file, e.g. "Left Extended" or "Right Grasping",
+		or a {pose: weight} blend of them
 		'''
 		category = params["position"]
 		duration = params["duration"]
+		names, angles = self.poses.resolve(category, "arm")
 		print("Robot moving arm to {} at duration {}".format(category, duration))
-		if category == "Left Extended":
-			names = ["LWristYaw", "LShoulderRoll", "LShoulderPitch", "LElbowRoll", "LElbowYaw"]
-			angles = [math.radians(-81.2), math.radians(11.5), math.radians(46.9), math.radians(-40.9), math.radians(-98.0)]
-		if category == "Right Extended":
-			names = ["RWristYaw", "RShoulderRoll", "RShoulderPitch", "RElbowRoll", "RElbowYaw"]
-			angles = [math.radians(81.2), math.radians(-11.5), math.radians(46.9), math.radians(40.9), math.radians(98.0)]
-		if category == "Left Retracted":
-			names = ["LWristYaw", "LShoulderRoll", "LShoulderPitch", "LElbowRoll", "LElbowYaw"]
-			angles = [math.radians(1.9), math.radians(6.0), math.radians(101.2), math.radians(-6.5), math.radians(-98.0)]
-		if category == "Right Retracted":
-			names = ["RWristYaw", "RShoulderRoll", "RShoulderPitch", "RElbowRoll", "RElbowYaw"]
-			angles = [math.radians(-1.3), math.radians(-6.0), math.radians(100.0), math.radians(5.9), math.radians(98.0)]
-		if category == "Left Open":
-			names = ["LHand"]
-			angles = [0.98]
-		if category == "Right Open":
-			names = ["RHand"]
-			angles = [0.98]
-		if category == "Left Grasping":
-			names = ["LHand"]
-			angles = [.26]
-		if category == "Right Grasping":
-			names = ["RHand"]
-			angles = [.26]
 		time_ip, angles_ip = self.ip(names, angles, duration)
-		self.motion_service.angleInterpolation(names, angles_ip, time_ip, True)
+		self.move_joints(names, angles_ip, time_ip)
 		print("Done moving arm to {} at speed {}".format(category, duration))
 
 	def head(self, params):
@@ -391,60 +857,24 @@ class Behaviors:
 			elif self.head_yaw == "Left":
 				self.head_yaw = "YawStraight"
 			category = self.head_yaw
-		if category == "YawStraight":
-			names = ["HeadYaw"]
-			angles = [math.radians(1.1)]
-		if category == "PitchStraight":
-			names = ["HeadPitch"]
-			angles = [math.radians(-21.9)]
-		if category == "Up":
-			names = ["HeadPitch"]
-			angles = [math.radians(-40.5)]
-		if category == "Down":
-			names = ["HeadPitch"]
-			angles = [math.radians(25.5)]
-		if category == "Left":
-			names = ["HeadYaw"]
-			angles = [math.radians(49.0)]
-		if category == "Right":
-			names = ["HeadYaw"]
-			angles = [math.radians(-49.0)]
+		names, angles = self.poses.resolve(category, "head")
 		print("Robot moving head to {} at duration {}".format(category, duration))
 		time_ip, angles_ip = self.ip(names, angles, duration)
-		self.motion_service.angleInterpolation(names, angles_ip, time_ip, True)
+		self.move_joints(names, angles_ip, time_ip)
 		print("Done moving head to {} at speed {}".format(category, duration))
 
 	def posture(self, params):
+		'''
+		position -- a "posture" pose from the pose file, or a {pose: weight} blend of them,
+		e.g. {"Welcoming": 0.3, "Standing": 0.7}
+		'''
 		category = params["position"]
 		duration = params["duration"]
-		names = ["HeadPitch", "HeadYaw",
-				 "LWristYaw", "LShoulderRoll", "LShoulderPitch", "LElbowRoll", "LElbowYaw", "LHand",
-				 "RWristYaw", "RShoulderRoll", "RShoulderPitch", "RElbowRoll", "RElbowYaw", "RHand",
-				 "HipPitch", "HipRoll", "KneePitch"]
-		if category == "Standing":
-			angles = [math.radians(-11.1), math.radians(0.0),
-					  math.radians(1.9), math.radians(6.0), math.radians(101.2), math.radians(-6.5), math.radians(-98.0), 0.60,
-					  math.radians(-1.3), math.radians(-6.0), math.radians(100.0), math.radians(5.9), math.radians(98.0), 0.60,
-					  math.radians(-2.0), math.radians(0.0), math.radians(0.6)]
-		elif category == "Resting":
-			angles = [math.radians(25.5), math.radians(0.0),
-					  math.radians(-46.2), math.radians(3.4), math.radians(65.5), math.radians(-0.6), math.radians(-27.9), 0.60,
-					  math.radians(46.2), math.radians(-3.6), math.radians(65.2), math.radians(0.5), math.radians(27.8), 0.60,
-					  math.radians(-59.5), math.radians(0.0), math.radians(28.9)]
-		elif category == "Welcoming": 
-			angles = [math.radians(-11.1), math.radians(0.0),
-					  math.radians(1.9), math.radians(43.6), math.radians(71.3), math.radians(-39.8), math.radians(-119.4), 0.74,
-					  math.radians(22.7), math.radians(-24.7), math.radians(59.9), math.radians(41.8), math.radians(119.1), 0.70,
-					  math.radians(-2.0), math.radians(0.0), math.radians(0.6)]
-		elif category == "Hands on hips":
-			angles = [math.radians(-11.1), math.radians(0.0),
-					  math.radians(-103.5), math.radians(48.5), math.radians(85.2), math.radians(-85.7), math.radians(-11.0), 0.13,
-					  math.radians(104.1), math.radians(-48.7), math.radians(74.6), math.radians(89.5), math.radians(-7.1), 0.02,
-					  math.radians(-2.0), math.radians(0.0), math.radians(0.6)]
+		names, angles = self.poses.resolve(category, "posture")
 		print("{} at duration {}".format(category, duration))
 		self.set_stiffness(0.9, "Body")
 		time_ip, angles_ip = self.ip(names, angles, duration)
-		self.motion_service.angleInterpolation(names, angles_ip, time_ip, True)
+		self.move_joints(names, angles_ip, time_ip)
 		self.set_stiffness(0.6, "Body")
 		print("Done {} at duration {}".format(category, duration))
 
@@ -493,85 +923,114 @@ class Behaviors:
 		print(animation_string)
 		
 		print("Robot saying {}".format(speech))
-		tts.say("{}\\vol={}\\\\vct={}\\\\rspd={}\\{}".format(animation_string, volume, pitch, speed, speech))
+		self.wait_for(tts.say("{}\\vol={}\\\\vct={}\\\\rspd={}\\{}".format(animation_string, volume, pitch, speed, speech), _async=True))
 		print("Robot done saying")
 
 	def locomote(self, forward, yaw):
-		if self.moving:
-			self.motion_service.move(forward, 0, yaw)
+		self.locomotion.set_target(forward, yaw, self.dispatch_started)
 		if abs(forward) > 0 or abs(yaw) > 0:
-			self.moving = True
-			print("moving - {}, {}".format(forward, yaw))
-		else:
-			self.moving = False
+			self.telemetry.debug("locomote", "moving - {:.3f} m/s, {:.3f} rad/s", forward, yaw)
 
-	def head_animation(self):
+	def head_animation(self, seed=None, wait=True):
 		# -21.5 <= pitch <= 8.2
 		# -41.7 <= yaw <= 41.7
-		# 0.2 <= time <= 0.8
+		# 1.0 <= time <= 2.8
 		print("Beginning head animation.")
-		start_time = time.time()
-		time_elapsed = 0.0
-		while time_elapsed < 12.0:
-			names = ["HeadPitch", "HeadYaw"]
-			angles = [math.radians(random.uniform(-21.5, 8.2)), math.radians(random.uniform(-41.7, 41.7))]
-			time_ip, angles_ip = self.ip(names, angles, random.uniform(1.0, 2.8))
-			self.motion_service.angleInterpolation(names, angles_ip, time_ip, True)
-			time_elapsed = (time.time() - start_time)
-		print("Finished head animation.")
+		rng = random.Random(seed)
+		traj = self.trajectory(["HeadPitch", "HeadYaw"])
+		while traj.duration < 12.0:
+			angles = [math.radians(rng.uniform(-21.5, 8.2)), math.radians(rng.uniform(-41.7, 41.7))]
+			traj.move(angles, rng.uniform(1.0, 2.8))
+		future = self.play(traj, wait)
+		if wait:
+			print("Finished head animation.")
+		return future
 
 	def wave_animation(self):
 		try:
 			print("Setting up wave behavior...")
-			start_time = time.time()
-			time_elapsed = 0.0
 			names = ["LWristYaw", "LShoulderRoll", "LShoulderPitch", "LElbowRoll", "LElbowYaw", "LHand"]
 			angles = [math.radians(62.1), math.radians(30.9), math.radians(-22.9), math.radians(-52.4), math.radians(-73.1), 0.98]
-			time_ip, angles_ip = self.ip(names, angles, 4.0)
-			self.motion_service.angleInterpolation(names, angles_ip, time_ip, True)
-			print("Wave: done moving arm to initial pos...")
-
-			while time_elapsed < 12.0:
-				names = ["LWristYaw"]
-				angles = [math.radians(66.5)]
-				time_ip, angles_ip = self.ip(names, angles, 2.0)
-				self.motion_service.angleInterpolation(names, angles_ip, time_ip, True)
-				angles[0] = math.radians(-16.9)
-				time_ip, angles_ip = self.ip(names, angles, 2.0)
-				self.motion_service.angleInterpolation(names, angles_ip, time_ip, True)
-				time_elapsed = (time.time() - start_time)
+			traj = self.trajectory(names)
+			traj.move(angles, 4.0)
+			while traj.duration < 12.0:
+				traj.move([math.radians(66.5)], 2.0, joints=["LWristYaw"])
+				traj.move([math.radians(-16.9)], 2.0, joints=["LWristYaw"])
+			self.play(traj)
 			print("Wave finished.")
+		except Cancelled:
+			raise
 		except:
 			print("Wave animation failed.")
 
+	def trajectory(self, joints):
+		'''
+		Starts a multi-waypoint trajectory for joints from their current angles.
+		'''
+		return trajectory.Trajectory(joints, self.joint_cache.get(joints), max_deviation=self.keyframe_deviation)
+
+	def play(self, traj, wait=True):
+		'''
+		Submits a compiled trajectory. Without wait, returns its future instead of blocking on it.
+		'''
+		names, angles, times = traj.compile()
+		future = self.motion_service.angleInterpolation(names, angles, times, True, _async=True)
+		if wait:
+			return self.wait_for(future)
+		task = self.running_task()
+		if task is not None:
+			task.track(future)
+		return future
+
+	def move_joints(self, names, angles, times):
+		self.wait_for(self.motion_service.angleInterpolation(names, angles, times, True, _async=True))
+
 	def set_stiffness(self, val, names):
 		stiffnessLists = val
 		timeLists = 1.0
-		self.motion_service.stiffnessInterpolation(names, stiffnessLists, timeLists)
+		self.wait_for(self.motion_service.stiffnessInterpolation(names, stiffnessLists, timeLists, _async=True))
 
-	def ip(self, joints, target_angles, seconds):
+	def ip(self, joints, target_angles, seconds, fresh=False):
 		'''
 		Joints -- list of joints to interpolate
 		target_angles - list of target angles, NOT CONVERTED to radians
+		fresh -- read the start angles from the robot instead of the joint cache
 		'''
-		time_dividor = 100
-		curr_angles = self.motion_service.getAngles(joints, True)
-		angle_multipliers = np.linspace(-6, 6, time_dividor)
-		angle_multipliers = 1 / (1 + np.exp(-angle_multipliers))
-		time_fragment = seconds / time_dividor
-		time_fractions = [i * time_fragment for i in range(1, time_dividor)]
-		time_fractions.append(seconds)
-		angles_interpolated = []
-		for i in range(len(target_angles)):
-			start = curr_angles[i]
-			end = target_angles[i]
-			interp = [start + (end - start) * mult.item() for mult in angle_multipliers]
-			angles_interpolated.append(interp)
-		times = [time_fractions for i in target_angles]
-		return times, angles_interpolated
+		curr_angles = self.joint_cache.get(joints, fresh=fresh)
+		return trajectory.interpolate(curr_angles, target_angles, seconds, max_deviation=self.keyframe_deviation)
 
 
 if __name__ == "__main__":
-	b = Behaviors()
+	parser = argparse.ArgumentParser()
+	parser.add_argument("ip", help="address of the robot, also the address the server listens on")
+	parser.add_argument("--fake-robot", action="store_true",
+						help="run against fake_naoqi instead of a robot, e.g. for benchmarks")
+	parser.add_argument("--fake-latency", type=float, default=0.002,
+						help="seconds every fake naoqi call takes")
+	parser.add_argument("--record", metavar="LOG", help="append every received frame to this session log")
+	parser.add_argument("--accel", type=float, nargs=2, default=(0.8, 2.0), metavar=("FORWARD", "YAW"),
+						help="base acceleration limits in m/s^2 and rad/s^2")
+	parser.add_argument("--decel", type=float, nargs=2, default=(1.6, 4.0), metavar=("FORWARD", "YAW"),
+						help="base deceleration limits in m/s^2 and rad/s^2")
+	parser.add_argument("--poses", default=POSES, help="pose file, see poses.py")
+	parser.add_argument("--log-level", choices=sorted(telemetry.LEVELS), default="info",
+						help="lowest telemetry level written to stdout")
+	parser.add_argument("--dump-seconds", type=float, default=5.0,
+						help="seconds of telemetry, debug included, written after an emergency stop (0 for none)")
+	parser.add_argument("--no-shm", action="store_true",
+						help="never offer the shared-memory channel to clients on this host")
+	args = parser.parse_args()
+	if args.fake_robot:
+		import fake_naoqi
+		b = Behaviors(args.ip, fake_naoqi.Session(call_latency=args.fake_latency), show_image=False, record=args.record,
+					  accel=args.accel, decel=args.decel, pose_file=args.poses,
+					  telemetry_level=telemetry.LEVELS[args.log_level], dump_seconds=args.dump_seconds,
+					  shm=not args.no_shm)
+	else:
+		b = Behaviors(args.ip, record=args.record, accel=args.accel, decel=args.decel, pose_file=args.poses,
+					  telemetry_level=telemetry.LEVELS[args.log_level], dump_seconds=args.dump_seconds,
+					  shm=not args.no_shm)
 	signal.signal(signal.SIGINT, b.signal_handler)
+	# kill -USR1 <pid> prints the latency percentiles
+	signal.signal(signal.SIGUSR1, b.latency_report)
 	b.connection_manager()
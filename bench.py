@@ -0,0 +1,617 @@
+'''
+Benchmarks for the control pipeline. Runs without a robot or gamepad, the
+server-side benchmarks run against fake_naoqi.
+
+    python bench.py                                # run everything
+    python bench.py framer ip                      # run selected benchmarks
+    python bench.py --json results.json            # also write the results as JSON
+    python bench.py --baseline bench_baseline.json # fail on regressions against a baseline
+    python bench.py --save-baseline bench_baseline.json
+'''
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import math
+import random
+import socket
+import struct
+import argparse
+import threading
+from functools import partial
+import protocol
+from shm_channel import ShmChannel
+
+
+def timed(fn, repeat=5):
+    '''
+    Best wall time of repeat runs of fn().
+    '''
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def record(results, key, value, unit, note="", slack=0.0, gate=True):
+    '''
+    Stores a result. Against a baseline, it only counts as a regression if it is
+    worse by more than the tolerance and by more than slack (in unit), and gate is set.
+    '''
+    results[key] = {"value": value, "unit": unit, "slack": slack, "gate": gate}
+    print("{:<32} {:>12,.1f} {:<9} {}".format(key, value, unit, note).rstrip())
+
+
+def higher_is_better(unit):
+    return unit.endswith("/s")
+
+
+class Quiet(object):
+    '''
+    Sends stdout to /dev/null, for code under test that prints on its hot path.
+    '''
+
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+
+    def __exit__(self, *exc):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+###########################
+# Encoding
+###########################
+def bench_encode(n_frames=20000):
+    '''
+    Frame encoding as done by Client.send_ev_ds, per wire protocol.
+    '''
+    rng = random.Random(0)
+    evs = []
+    for seq in range(100):
+        ev = protocol.empty_ev()
+        ev["velocity"] = rng.uniform(-1, 1)
+        ev["twist"] = rng.uniform(-1, 1)
+        ev["a"] = int(seq % 7 == 0)
+        evs.append(ev)
+    results = {}
+    for wire_protocol, name in ((protocol.PROTOCOL_JSON, "json"), (protocol.PROTOCOL_BINARY, "binary"),
+                                (protocol.PROTOCOL_STAMPED, "stamped")):
+        def run():
+            stamp = time.time()
+            for seq in range(n_frames):
+                protocol.encode(wire_protocol, evs[seq % 100], seq, stamp, 0.01)
+
+        elapsed = timed(run)
+        record(results, "encode." + name, n_frames / elapsed, "frames/s")
+    return results
+
+
+###########################
+# Framing
+###########################
+def split_points(stream, frame_size, pattern, rng):
+    '''
+    Chunk boundaries for feeding stream into a framer.
+    '''
+    if pattern == "byte":
+        step = 1
+    elif pattern == "straddle":
+        step = max(1, frame_size - 1)  # every frame is split, at a moving offset
+    elif pattern == "prime":
+        step = 13
+    elif pattern == "burst":
+        step = 4096
+    else:
+        step = None
+    cuts = []
+    pos = 0
+    while pos < len(stream):
+        cuts.append(pos)
+        pos += step if step is not None else rng.randint(1, 3 * frame_size)
+    cuts.append(len(stream))
+    return [stream[a:b] for a, b in zip(cuts, cuts[1:])]
+
+
+def bench_framer(n_frames=5000):
+    rng = random.Random(0)
+    ev = protocol.empty_ev()
+    streams = {}
+    for wire_protocol, name in ((protocol.PROTOCOL_JSON, "json"), (protocol.PROTOCOL_BINARY, "binary"),
+                                (protocol.PROTOCOL_STAMPED, "stamped")):
+        frames = []
+        for seq in range(n_frames):
+            ev["velocity"] = rng.uniform(-1, 1)
+            ev["a"] = int(seq % 7 == 0)
+            frames.append(protocol.encode(wire_protocol, ev, seq, time.time()))
+        streams[name] = (wire_protocol, b''.join(frames), len(frames[0]))
+
+    results = {}
+    for name in sorted(streams):
+        wire_protocol, stream, frame_size = streams[name]
+        for pattern in ("byte", "straddle", "prime", "random", "burst"):
+            chunks = split_points(stream, frame_size, pattern, rng)
+            counts = []
+
+            def run():
+                framer = protocol.Framer(wire_protocol)
+                count = 0
+                for chunk in chunks:
+                    framer.feed(chunk)
+                    for frame in framer.frames():
+                        protocol.decode_frame(wire_protocol, frame)
+                        count += 1
+                counts.append(count)
+
+            elapsed = timed(run)
+            if counts[-1] != n_frames:
+                raise AssertionError("framer yielded {} of {} frames".format(counts[-1], n_frames))
+            record(results, "framer.{}.{}".format(name, pattern), n_frames / elapsed, "frames/s",
+                   "({} chunks)".format(len(chunks)))
+    return results
+
+
+###########################
+# Trajectories
+###########################
+def legacy_ip(curr_angles, target_angles, seconds):
+    '''
+    Behaviors.ip before the trajectory module, kept as the comparison point.
+    '''
+    import numpy as np
+    time_dividor = 100
+    angle_multipliers = np.linspace(-6, 6, time_dividor)
+    angle_multipliers = 1 / (1 + np.exp(-angle_multipliers))
+    time_fragment = seconds / time_dividor
+    time_fractions = [i * time_fragment for i in range(1, time_dividor)]
+    time_fractions.append(seconds)
+    angles_interpolated = []
+    for i in range(len(target_angles)):
+        start = curr_angles[i]
+        end = target_angles[i]
+        interp = [start + (end - start) * mult.item() for mult in angle_multipliers]
+        angles_interpolated.append(interp)
+    times = [time_fractions for i in target_angles]
+    return times, angles_interpolated
+
+
+def bench_ip(calls=2000):
+    import trajectory
+    rng = random.Random(0)
+    results = {}
+    for n_joints in (1, 5, 17):
+        curr = [rng.uniform(-1, 1) for _ in range(n_joints)]
+        target = [rng.uniform(-1, 1) for _ in range(n_joints)]
+        legacy = legacy_ip(curr, target, 4.0)
+        current = trajectory.interpolate(curr, target, 4.0)
+        for rows_a, rows_b in zip(legacy, current):
+            for row_a, row_b in zip(rows_a, rows_b):
+                if max(abs(a - b) for a, b in zip(row_a, row_b)) > 1e-9:
+                    raise AssertionError("trajectory.interpolate diverges from the legacy ip()")
+        adaptive = partial(trajectory.interpolate, max_deviation=math.radians(0.2))
+        for name, fn in (("legacy", legacy_ip), ("vectorized", trajectory.interpolate), ("adaptive", adaptive)):
+            elapsed = timed(lambda: [fn(curr, target, 4.0) for _ in range(calls)])
+            keyframes = sum(len(row) for row in fn(curr, target, 4.0)[1])
+            record(results, "ip.{}.{}joints".format(name, n_joints), elapsed / calls * 1e6, "us/call",
+                   "({} keyframes)".format(keyframes))
+    return results
+
+
+def bench_poses(calls=20000):
+    '''
+    Target angles of a posture from the pose library: a lookup, and a blend of two postures.
+    '''
+    import poses
+    from behaviors import BODY_JOINTS, POSES
+    library = poses.load(BODY_JOINTS, POSES)
+    weights = {"Welcoming": 0.3, "Standing": 0.7}
+    results = {}
+    elapsed = timed(lambda: [library.resolve("Standing", "posture") for _ in range(calls)])
+    # a dict access, too short to gate on a relative change alone
+    record(results, "poses.lookup", elapsed / calls * 1e6, "us/call", slack=0.5)
+    elapsed = timed(lambda: [library.resolve(weights, "posture") for _ in range(calls)])
+    record(results, "poses.blend", elapsed / calls * 1e6, "us/call")
+    return results
+
+
+###########################
+# Server
+###########################
+def fake_behaviors(**session_args):
+    '''
+    Behaviors on fake_naoqi whose telemetry writes nothing, not even the emergency
+    stop dump: its writer thread would print after Quiet has ended.
+    '''
+    import fake_naoqi
+    import telemetry
+    from behaviors import Behaviors
+    with Quiet():
+        return Behaviors("127.0.0.1", fake_naoqi.Session(**session_args), show_image=False,
+                         telemetry_level=telemetry.OFF, dump_seconds=0)
+
+
+def bench_telemetry(calls=50000):
+    '''
+    telemetry.event on the control path, for an event below the output level
+    (ring only) and one at it (ring and writer queue), against a print.
+    '''
+    import telemetry
+    log = telemetry.Telemetry(telemetry.INFO, flush_interval=0.01)
+    results = {}
+    with Quiet():
+        elapsed_debug = timed(lambda: [log.debug("decider", "forward {:.3f} twist {:.3f}", 0.2, 0.0) for _ in range(calls)])
+        elapsed_info = timed(lambda: [log.info("decider", "forward {:.3f} twist {:.3f}", 0.2, 0.0) for _ in range(calls)])
+        elapsed_print = timed(lambda: [print("forward {:.3f} twist {:.3f}".format(0.2, 0.0)) for _ in range(calls)])
+    record(results, "telemetry.debug", elapsed_debug / calls * 1e6, "us/call", slack=0.5)
+    record(results, "telemetry.info", elapsed_info / calls * 1e6, "us/call", slack=0.5)
+    record(results, "telemetry.print", elapsed_print / calls * 1e6, "us/call", "(to /dev/null)", gate=False)
+    return results
+
+
+def bench_startup(call_latency=0.02):
+    '''
+    Behaviors startup against fake_naoqi with a round trip of call_latency:
+    until the constructor returns (the listener can start) and until warm-up is done.
+    '''
+    import behaviors  # not counting the imports
+    start = time.time()
+    b = fake_behaviors(call_latency=call_latency, posture_seconds=0.5)
+    constructed = time.time() - start
+    with Quiet():
+        b.ready.wait(10.0)
+    ready = time.time() - start
+    results = {}
+    # a few scheduler slices on a loaded machine
+    record(results, "startup.constructed", 1000 * constructed, "ms", slack=20.0)
+    record(results, "startup.ready", 1000 * ready, "ms", gate=False)
+    return results
+
+
+def bench_decider(calls=20000):
+    '''
+    Behaviors.behavior_decider for the frames that make up the 20 Hz stream:
+    idle (nothing pressed) and driving (axes changing every frame).
+    '''
+    b = fake_behaviors(call_latency=0.0, posture_seconds=0.0)
+    idle = protocol.empty_ev()
+    driving = [protocol.empty_ev(), protocol.empty_ev()]
+    driving[0]["velocity"], driving[1]["velocity"] = 0.5, 0.6
+    results = {}
+    with Quiet():
+        elapsed_idle = timed(lambda: [b.behavior_decider(idle) for _ in range(calls)])
+        elapsed_driving = timed(lambda: [b.behavior_decider(driving[i % 2]) for i in range(calls)])
+        b.behavior_decider(idle)
+    record(results, "decider.idle", elapsed_idle / calls * 1e6, "us/call")
+    record(results, "decider.driving", elapsed_driving / calls * 1e6, "us/call")
+    return results
+
+
+# the server on 127.0.0.1:8888, shared because only one can listen there
+fake_servers = []
+
+
+def fake_server():
+    '''
+    The fake_naoqi server that the loopback benchmarks connect to, started
+    on first use. Waits for the previous client's teardown and unlocks the robot.
+    '''
+    if not fake_servers:
+        b = fake_behaviors()
+        with Quiet():
+            b.ready.wait(10.0)
+            thread = threading.Thread(target=b.serve)
+            thread.daemon = True  # Daemonize thread
+            thread.start()
+        fake_servers.append(b)
+    b = fake_servers[0]
+    # the previous client's disconnect stopped and locked the robot
+    while b.conn is not None:
+        time.sleep(0.01)
+    with Quiet():
+        b.unlock()
+    return b
+
+
+def connect_loopback(shm, session=None):
+    '''
+    Connects to a server on 127.0.0.1 as a client would. Returns (conn, wire protocol, ShmChannel or None).
+    '''
+    deadline = time.time() + 5.0
+    while True:
+        try:
+            conn = socket.create_connection(("127.0.0.1", 8888), timeout=1.0)
+            break
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+    protocol.tune_socket(conn)
+    conn.sendall(protocol.hello(session=session, shm=shm))
+    wire_protocol, _, shm_path = protocol.parse_accept(conn.makefile("rb").readline())
+    channel = None
+    if shm:
+        if shm_path is None:
+            raise AssertionError("the server did not open the shared-memory channel")
+        channel = ShmChannel.open(shm_path)
+    return conn, wire_protocol, channel
+
+
+def loopback_latencies(b, n_frames, rate, shm):
+    '''
+    Connects to the server of b and sends n_frames with a distinct velocity each.
+    Returns the delays from each send to the frame reaching the dispatcher and
+    to the move call it caused, both sorted.
+    '''
+    conn, wire_protocol, channel = connect_loopback(shm)
+    arrivals = {}  # move(x, ...) argument -> time the frame reached the dispatcher
+    submit_many = b.dispatcher.submit_many
+
+    def submitted(evs, received_at=None):
+        for ev in evs:
+            arrivals.setdefault(ev["velocity"] * 0.4, time.time())
+        submit_many(evs, received_at)
+
+    b.dispatcher.submit_many = submitted
+    started = time.time()
+    sent = {}  # move(x, ...) argument -> send time
+    ev = protocol.empty_ev()
+    for seq in range(n_frames):
+        # alternate the direction, so that every frame is a change beyond the move threshold
+        ev["velocity"] = (0.5 + 0.5 * (seq + 1.0) / (n_frames + 1)) * (-1) ** seq
+        # the value the server decodes, float32 on the binary protocols
+        velocity = ev["velocity"]
+        if wire_protocol != protocol.PROTOCOL_JSON and channel is None:
+            velocity = struct.unpack("<f", struct.pack("<f", velocity))[0]
+        stamp = time.time()
+        sent[velocity * 0.4] = stamp
+        if channel is not None:
+            channel.write_axes(seq, stamp, ev["velocity"], ev["twist"], 0.0)
+            if seq % int(rate * protocol.IDLE_HEARTBEAT) == 0:
+                # the client's heartbeat, the server ignores its axes
+                conn.sendall(protocol.encode(wire_protocol, ev, seq, stamp))
+        else:
+            conn.sendall(protocol.encode(wire_protocol, ev, seq, stamp, 0.0))
+        time.sleep(max(0.0, stamp + 1.0 / rate - time.time()))
+    time.sleep(0.2)
+    conn.close()
+    if channel is not None:
+        channel.close()
+    del b.dispatcher.submit_many
+
+    wire = sorted(arrivals[x] - sent[x] for x in sent if x in arrivals)
+    latencies = []
+    # calls keeps the latest 10000 calls, minutes of a run at 50 getAngles a second
+    for service, method, args, start, _, _ in list(b.session.calls):
+        if method == "move" and start >= started and args[0] in sent:
+            latencies.append(start - sent[args[0]])
+    latencies.sort()
+    if not latencies:
+        raise AssertionError("no move call could be matched to a frame")
+    return wire, latencies
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def bench_loopback(n_frames=200, rate=50.0):
+    '''
+    Client send to ALMotion.move over loopback: a server on fake_naoqi is
+    sent stamped frames with a distinct velocity each, and every move call is
+    matched back to the frame that caused it. Ramping is turned off so that
+    move is called with the frame's velocity, which includes the wait for the
+    next tick of the locomotion controller. Runs once over TCP and once with
+    the axes in shared memory (shm_channel.py); the wire results are the time
+    from send until the server hands the frame to the dispatcher.
+    '''
+    results = {}
+    for prefix, shm in (("loopback", False), ("loopback.shm", True)):
+        b = fake_server()
+        limits = b.locomotion.accel, b.locomotion.decel
+        b.locomotion.accel = b.locomotion.decel = (float("inf"), float("inf"))
+        with Quiet():
+            wire, latencies = loopback_latencies(b, n_frames, rate, shm)
+            time.sleep(0.2)
+        b.locomotion.accel, b.locomotion.decel = limits
+        note = "({} of {} frames reached move)".format(len(latencies), n_frames)
+        # the shared-memory figures are set by the 1 ms poll rather than the scheduler and
+        # gated tightly, the channel is only worth offering by default once it beats TCP
+        wire_slack = 0.2 if shm else 1.0
+        record(results, prefix + ".wire.p50", 1000 * percentile(wire, 0.5), "ms", slack=wire_slack)
+        record(results, prefix + ".wire.p99", 1000 * percentile(wire, 0.99), "ms", slack=wire_slack)
+        # frames are sent at the rate of the locomotion ticks, so whether a frame makes the
+        # next tick depends on the phase between the two, set by the first frame of a run.
+        # The server polls shared memory every millisecond, which moves frames across that
+        # edge, so its send to move figures are not gated.
+        gate = not shm
+        # below a millisecond the scheduler dominates, the control loop runs every 50 ms
+        record(results, prefix + ".p50", 1000 * percentile(latencies, 0.5), "ms", note, slack=1.0, gate=gate)
+        record(results, prefix + ".p99", 1000 * percentile(latencies, 0.99), "ms", slack=1.0, gate=gate)
+        record(results, prefix + ".max", 1000 * latencies[-1], "ms", gate=False)
+    return results
+
+
+def bench_presses(rounds=6, per_round=20):
+    '''
+    Exactly-once delivery of button presses across reconnects, over TCP and
+    shared memory. Every round sends new presses after the unacknowledged ones;
+    every other round hangs up without reading the acknowledgements, so the next
+    one resends presses the server already has. The first round starts with a
+    malformed press, which must be dropped without costing the connection.
+    Raises AssertionError unless each press reached the dispatcher, and
+    triggered behavior_decider, exactly once.
+    '''
+    b = fake_server()
+    delivered = []
+    triggered = []
+    submit_many = b.dispatcher.submit_many
+    behavior_decider = b.behavior_decider
+
+    def submitted(evs, received_at=None):
+        delivered.extend(ev for ev in evs if ev["left"])
+        submit_many(evs, received_at)
+
+    def decided(ev):
+        if ev["left"]:
+            triggered.append(ev)
+        behavior_decider(ev)
+
+    b.dispatcher.submit_many = submitted
+    b.behavior_decider = decided
+    results = {}
+    for name, shm in (("tcp", False), ("shm", True)):
+        queue = protocol.PressQueue()
+        del delivered[:]
+        del triggered[:]
+        duplicates = b.presses.stats["duplicates"]
+        with Quiet():
+            for i in range(rounds):
+                conn, wire_protocol, channel = connect_loopback(shm, queue.session)
+                queue.resend()
+                batches = [queue.take()]
+                if i == 0:
+                    # on its own, before the session delivered anything; button index 20 does not exist
+                    batches.insert(0, protocol.PRESS_STRUCT.pack(protocol.PRESS_MAGIC, protocol.PROTOCOL_EVENTS, 0, 20, 0.0))
+                for _ in range(per_round):
+                    queue.press("left", time.time())
+                batches.append(queue.take())
+                for data in batches:
+                    if channel is not None:
+                        if channel.push_presses(data):
+                            raise AssertionError("presses did not fit into the shared-memory ring")
+                    else:
+                        conn.sendall(data)
+                    time.sleep(0.02)
+                if i % 2 == 0 or i == rounds - 1:
+                    framer = protocol.Framer(wire_protocol)
+                    deadline = time.time() + 2.0
+                    while queue.pending() and time.time() < deadline and framer.recv_from(conn):
+                        for frame in framer.frames():
+                            if protocol.message_type(frame) == protocol.ACK_MAGIC:
+                                queue.ack(protocol.decode_ack(frame))
+                    if queue.pending():
+                        raise AssertionError("{} presses of round {} were not acknowledged".format(queue.pending(), i))
+                else:
+                    # give the server time to read them, then hang up unacknowledged
+                    time.sleep(0.05)
+                conn.close()
+                if channel is not None:
+                    channel.close()
+                while b.conn is not None:
+                    time.sleep(0.01)
+        if len(delivered) != rounds * per_round:
+            raise AssertionError("{} presses over {} reached the dispatcher {} times".format(
+                rounds * per_round, name, len(delivered)))
+        # the dispatcher may still be working through the last round
+        deadline = time.time() + 2.0
+        while len(triggered) < len(delivered) and time.time() < deadline:
+            time.sleep(0.01)
+        if len(triggered) != rounds * per_round:
+            raise AssertionError("{} presses over {} triggered behavior_decider {} times".format(
+                rounds * per_round, name, len(triggered)))
+        record(results, "presses.{}.duplicates".format(name), float(b.presses.stats["duplicates"] - duplicates),
+               "presses", "(dropped, {} delivered exactly once)".format(len(delivered)), gate=False)
+    del b.dispatcher.submit_many
+    del b.behavior_decider
+    return results
+
+
+def bench_locomotion(seconds=3.0, rate=20.0):
+    '''
+    move calls of the locomotion controller for a 20 Hz frame stream with
+    jittered arrivals: the stick is pushed to 0.8 at once, held with a little
+    sensor noise, then released.
+    '''
+    from locomotion import LocomotionController
+    moves = []
+    controller = LocomotionController(lambda forward, yaw: moves.append((forward, yaw)))
+    rng = random.Random(0)
+    n_frames = int(seconds * rate)
+    per_frame = 0  # move calls of one call per frame while driving
+    previous = 0.0
+    start = time.time()
+    for i in range(n_frames):
+        t = i / rate
+        stick = 0.8 + rng.uniform(-0.01, 0.01) if 0.5 <= t < seconds - 0.5 else 0.0
+        per_frame += 1 if stick or previous else 0
+        previous = stick
+        controller.set_target(0.4 * stick, 0.0)
+        # frames arrive bunched up or late by up to 40 ms
+        time.sleep(max(0.0, start + t + rng.uniform(0.0, 0.04) - time.time()))
+    time.sleep(0.5)
+    results = {}
+    record(results, "locomotion.moves", float(len(moves)), "calls",
+           "(instead of {} for {} frames)".format(per_frame, n_frames), gate=False)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Prints every result next to its baseline, returns the keys that are worse by more than tolerance.
+    '''
+    regressions = []
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        result = results[key]
+        value, unit = result["value"], result["unit"]
+        reference = baseline[key]["value"]
+        if higher_is_better(unit):
+            change = reference / value - 1 if value else float("inf")
+        else:
+            change = value / reference - 1 if reference else 0.0
+        regressed = result["gate"] and change > tolerance and abs(value - reference) > result["slack"]
+        if regressed:
+            regressions.append(key)
+        print("{:<32} {:>12,.1f} vs {:>12,.1f} {:<9} {:+6.0%} worse{}".format(
+            key, value, reference, unit, change, "  REGRESSION" if regressed else ""))
+    return regressions
+
+
+BENCHMARKS = {
+    "encode": bench_encode,
+    "framer": bench_framer,
+    "ip": bench_ip,
+    "poses": bench_poses,
+    "startup": bench_startup,
+    "telemetry": bench_telemetry,
+    "decider": bench_decider,
+    "loopback": bench_loopback,
+    "locomotion": bench_locomotion,
+    "presses": bench_presses,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("names", nargs="*", help="benchmarks to run: " + ", ".join(sorted(BENCHMARKS)))
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare against the results stored in this file")
+    parser.add_argument("--save-baseline", help="store the results as a baseline in this file")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="fraction by which a result may be worse than the baseline")
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark: " + name)
+
+    results = {}
+    for name in args.names or sorted(BENCHMARKS):
+        results.update(BENCHMARKS[name]())
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print()
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("{} regression(s): {}".format(len(regressions), ", ".join(regressions)))
+            sys.exit(1)
@@ -0,0 +1,331 @@
+'''
+Long-lived worker threads for the robot server. Must stay python 2.7 compatible.
+
+Dispatcher -- hands received frames to a handler on one thread. The
+              locomotion axes live in a latest-value slot (older values are
+              simply overwritten), frames with button presses go through a
+              bounded FIFO. After a stall the robot catches up at once: the
+              axes that piled up collapse into the newest, and every press is
+              dispatched on its own with the newest axes riding on the last
+              one, so two presses of one button trigger twice. A queued
+              emergency stop ("info") instead coalesces everything pending
+              into a single stop (see protocol.coalesce).
+              A held dispatcher queues frames until release(), except that
+              an emergency stop ("info") is dispatched at once.
+Runner     -- runs submitted jobs one at a time on one thread, used for
+              blocking behaviors so they never stall the dispatcher.
+Watchdog   -- calls a handler from its own thread when no frame arrived
+              within a deadline, and keeps arrival jitter statistics.
+Task       -- a cancellable behavior. Its blocking robot calls are issued
+              asynchronously and awaited through Task.wait, so cancel()
+              aborts them and unwinds the behavior with Cancelled.
+'''
+from __future__ import print_function
+import time
+import threading
+import math
+import itertools
+import traceback
+from collections import deque
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from protocol import BUTTONS, coalesce
+
+
+class Dispatcher(object):
+
+    def __init__(self, handler, max_queue=64, report_interval=60.0, histogram=None, output=print, held=False):
+        self.handler = handler
+        self.held = held
+        self.histogram = histogram  # optional latency.RollingHistogram of receive-to-dispatch times
+        # called with the stats line; runs on the dispatch thread, so it must not block
+        self.output = output
+        self.max_queue = max_queue
+        self.report_interval = report_interval
+        self.cond = threading.Condition()
+        self.axes = None  # (received_at, ev) newest axes-only frame not yet dispatched
+        self.buttons = deque()  # (received_at, ev) frames with a button press, oldest first
+        self.reset_stats()
+        self.thread = threading.Thread(target=self.loop)
+        self.thread.daemon = True  # Daemonize thread
+        self.thread.start()
+
+    def reset_stats(self):
+        self.stats = {
+            "frames": 0,
+            "dispatches": 0,
+            "coalesced": 0,
+            "folded": 0,
+            "max_depth": 0,
+            "latency_count": 0,
+            "latency_sum": 0.0,
+            "latency_max": 0.0,
+        }
+        self.last_report = time.time()
+
+    def submit(self, ev, received_at=None):
+        self.submit_many([ev], received_at)
+
+    def submit_many(self, evs, received_at=None):
+        '''
+        Queues frames received together, oldest first.
+        '''
+        if not evs:
+            return
+        received_at = time.time() if received_at is None else received_at
+        with self.cond:
+            for ev in evs:
+                self.stats["frames"] += 1
+                if self.axes is not None:
+                    # a newer frame always carries newer axes
+                    self.stats["coalesced"] += 1
+                    self.axes = None
+                if not any(ev[name] for name in BUTTONS):
+                    self.axes = (received_at, ev)
+                else:
+                    if len(self.buttons) >= self.max_queue:
+                        # never drop a press, fold the oldest frame into its successor
+                        oldest_at, oldest = self.buttons.popleft()
+                        _, successor = self.buttons.popleft()
+                        self.buttons.appendleft((oldest_at, coalesce([oldest, successor])))
+                        self.stats["folded"] += 1
+                    self.buttons.append((received_at, ev))
+                    self.stats["max_depth"] = max(self.stats["max_depth"], len(self.buttons))
+            self.cond.notify()
+
+    def release(self):
+        '''
+        Dispatches what was queued while held, and every frame from now on.
+        '''
+        with self.cond:
+            self.held = False
+            self.cond.notify()
+
+    def stop_pending(self):
+        '''
+        True if an emergency stop is queued. Caller must hold self.cond.
+        '''
+        return any(ev["info"] for _, ev in self.buttons)
+
+    def depth(self):
+        with self.cond:
+            return len(self.buttons)
+
+    def loop(self):
+        while True:
+            with self.cond:
+                while (self.axes is None and not self.buttons) or (self.held and not self.stop_pending()):
+                    self.cond.wait(1.0)
+                    self.maybe_report()
+                pending = list(self.buttons)
+                self.buttons.clear()
+                axes, self.axes = self.axes, None
+
+            if any(frame["info"] for _, frame in pending):
+                groups = [pending + ([axes] if axes is not None else [])]
+            else:
+                groups = [[entry] for entry in pending]
+                if axes is not None:
+                    if groups:
+                        groups[-1].append(axes)
+                    else:
+                        groups.append([axes])
+            for group in groups:
+                ev = coalesce([frame for _, frame in group])
+                self.record_dispatch(time.time(), [received_at for received_at, _ in group])
+                try:
+                    self.handler(ev)
+                except Exception:
+                    print("Error encountered when dispatching frame.")
+                    traceback.print_exc()
+            with self.cond:
+                self.maybe_report()
+
+    def record_dispatch(self, now, received):
+        with self.cond:
+            self.stats["dispatches"] += 1
+            self.stats["coalesced"] += len(received) - 1
+            for received_at in received:
+                latency = now - received_at
+                self.stats["latency_count"] += 1
+                self.stats["latency_sum"] += latency
+                self.stats["latency_max"] = max(self.stats["latency_max"], latency)
+                if self.histogram is not None:
+                    self.histogram.record(latency, now)
+
+    def report(self):
+        stats = self.stats
+        mean = stats["latency_sum"] / stats["latency_count"] if stats["latency_count"] else 0.0
+        return ("dispatch: {} frames in {} dispatches ({} coalesced, {} folded), queue depth {} (max {}), "
+                "latency mean {:.1f} ms max {:.1f} ms").format(
+            stats["frames"], stats["dispatches"], stats["coalesced"], stats["folded"],
+            len(self.buttons), stats["max_depth"], mean * 1000, stats["latency_max"] * 1000)
+
+    def flush_report(self):
+        with self.cond:
+            self.maybe_report(force=True)
+
+    def maybe_report(self, force=False):
+        '''
+        Outputs and resets the stats. Caller must hold self.cond.
+        '''
+        if not force and time.time() - self.last_report < self.report_interval:
+            return
+        if self.stats["frames"] > 0:
+            self.output(self.report())
+        self.reset_stats()
+
+
+class Runner(object):
+
+    def __init__(self):
+        self.jobs = queue.Queue()
+        thread = threading.Thread(target=self.loop)
+        thread.daemon = True  # Daemonize thread
+        thread.start()
+
+    def submit(self, fn, *args):
+        self.jobs.put((fn, args))
+
+    def loop(self):
+        while True:
+            fn, args = self.jobs.get()
+            try:
+                fn(*args)
+            except Exception:
+                print("Error encountered when running behavior.")
+                traceback.print_exc()
+
+
+class Watchdog(object):
+
+    def __init__(self, deadline, on_expire, poll=None):
+        self.deadline = deadline
+        self.on_expire = on_expire
+        self.poll = deadline / 5.0 if poll is None else poll
+        self.lock = threading.Lock()
+        self.last = None  # arrival time of the last frame, None while disarmed
+        self.expired = False
+        self.reset_stats()
+        thread = threading.Thread(target=self.loop)
+        thread.daemon = True  # Daemonize thread
+        thread.start()
+
+    def reset_stats(self):
+        self.stats = {
+            "misses": 0,
+            "intervals": 0,
+            "interval_mean": 0.0,
+            "interval_m2": 0.0,
+            "interval_max": 0.0,
+        }
+
+    def feed(self, now=None):
+        '''
+        Records a frame arrival and (re)arms the watchdog.
+        '''
+        now = time.time() if now is None else now
+        with self.lock:
+            if self.last is not None:
+                # running mean/variance of arrival intervals (Welford)
+                interval = now - self.last
+                stats = self.stats
+                stats["intervals"] += 1
+                delta = interval - stats["interval_mean"]
+                stats["interval_mean"] += delta / stats["intervals"]
+                stats["interval_m2"] += delta * (interval - stats["interval_mean"])
+                stats["interval_max"] = max(stats["interval_max"], interval)
+            self.last = now
+            self.expired = False
+
+    def disarm(self):
+        with self.lock:
+            self.last = None
+
+    def loop(self):
+        while True:
+            time.sleep(self.poll)
+            with self.lock:
+                fire = self.last is not None and not self.expired and time.time() - self.last > self.deadline
+                if fire:
+                    # fire once per silence, the next frame re-arms
+                    self.expired = True
+                    self.stats["misses"] += 1
+            if fire:
+                try:
+                    self.on_expire()
+                except Exception:
+                    print("Error encountered in watchdog handler.")
+                    traceback.print_exc()
+
+    def report(self):
+        with self.lock:
+            stats = self.stats
+            jitter = math.sqrt(stats["interval_m2"] / stats["intervals"]) if stats["intervals"] else 0.0
+            line = ("watchdog: {} deadline misses ({:.0f} ms deadline), {} intervals, "
+                    "mean {:.1f} ms jitter {:.1f} ms max {:.1f} ms").format(
+                stats["misses"], self.deadline * 1000, stats["intervals"],
+                stats["interval_mean"] * 1000, jitter * 1000, stats["interval_max"] * 1000)
+            self.reset_stats()
+        return line
+
+
+class Cancelled(Exception):
+    pass
+
+
+class Task(object):
+
+    _ids = itertools.count(1)
+
+    def __init__(self, name):
+        self.id = next(Task._ids)
+        self.name = name
+        self.thread = None  # set by whoever runs the task
+        self.lock = threading.Lock()
+        self.futures = []
+        self.cancelled_at = None
+
+    def is_cancelled(self):
+        return self.cancelled_at is not None
+
+    def track(self, future):
+        '''
+        Registers a qi.Future to be cancelled along with the task.
+        '''
+        with self.lock:
+            if self.is_cancelled():
+                future.cancel()
+                raise Cancelled(self.name)
+            if future not in self.futures:
+                self.futures.append(future)
+
+    def wait(self, future, poll=0.05):
+        '''
+        Waits for a qi.Future and returns its value. Raises Cancelled, after
+        cancelling the future, if the task is cancelled first.
+        '''
+        self.track(future)
+        try:
+            while not future.isFinished():
+                if self.is_cancelled():
+                    raise Cancelled(self.name)
+                future.wait(int(poll * 1000))
+            if self.is_cancelled():
+                raise Cancelled(self.name)
+            return future.value()
+        finally:
+            with self.lock:
+                self.futures.remove(future)
+
+    def cancel(self):
+        with self.lock:
+            if self.cancelled_at is None:
+                self.cancelled_at = time.time()
+            futures = list(self.futures)
+        for future in futures:
+            future.cancel()
@@ -0,0 +1,388 @@
+'''
+Stand-in for a qi.Session with the naoqi services behaviors.py uses, for
+running the server without a robot:
+
+    python behaviors.py localhost --fake-robot
+
+Every call sleeps for a configurable RPC latency and is recorded. ALMotion
+keeps joint state. angleInterpolation and stiffnessInterpolation block for
+their duration while the joints move through the keyframes, and say()
+blocks for a time proportional to the text. Calls made with _async=True
+return a future that mimics qi.Future, cancellation included.
+Must stay python 2.7 compatible.
+'''
+from __future__ import print_function
+import time
+import functools
+import threading
+from collections import deque
+
+# angles in radians (hands: 0 closed .. 1 open) of the Standing posture
+STANDING = {
+    "HeadPitch": -0.19, "HeadYaw": 0.0,
+    "LWristYaw": 0.03, "LShoulderRoll": 0.10, "LShoulderPitch": 1.77, "LElbowRoll": -0.11, "LElbowYaw": -1.71, "LHand": 0.6,
+    "RWristYaw": -0.02, "RShoulderRoll": -0.10, "RShoulderPitch": 1.75, "RElbowRoll": 0.10, "RElbowYaw": 1.71, "RHand": 0.6,
+    "HipPitch": -0.03, "HipRoll": 0.0, "KneePitch": 0.01,
+}
+CHAINS = {
+    "Head": ["HeadPitch", "HeadYaw"],
+    "LArm": ["LShoulderPitch", "LShoulderRoll", "LElbowYaw", "LElbowRoll", "LWristYaw", "LHand"],
+    "RArm": ["RShoulderPitch", "RShoulderRoll", "RElbowYaw", "RElbowRoll", "RWristYaw", "RHand"],
+    "Leg": ["HipPitch", "HipRoll", "KneePitch"],
+}
+CHAINS["Body"] = CHAINS["Head"] + CHAINS["LArm"] + CHAINS["RArm"] + CHAINS["Leg"]
+CHAINS["Joints"] = CHAINS["Body"]
+
+
+class Future(object):
+    '''
+    The subset of qi.Future the server uses.
+    '''
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.cancel_requested = threading.Event()
+        self.result = None
+        self.error = None
+
+    def isFinished(self):
+        return self.done.is_set()
+
+    def wait(self, timeout=None):
+        # qi takes milliseconds
+        self.done.wait(None if timeout is None else timeout / 1000.0)
+
+    def value(self, timeout=None):
+        self.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def hasError(self, timeout=None):
+        self.wait(timeout)
+        return self.error is not None
+
+    def cancel(self):
+        self.cancel_requested.set()
+
+    def isCancelRequested(self):
+        return self.cancel_requested.is_set()
+
+
+class Cancelled(Exception):
+    pass
+
+
+def rpc(method):
+    '''
+    Makes a service method behave like a remote call: latency, recording and _async support.
+    '''
+    @functools.wraps(method)
+    def call(self, *args, **kwargs):
+        if not kwargs.pop("_async", False):
+            return self.session.invoke(self, method, args, kwargs, None)
+        future = Future()
+        thread = threading.Thread(target=self.session.invoke, args=(self, method, args, kwargs, future))
+        thread.daemon = True  # Daemonize thread
+        thread.start()
+        return future
+    return call
+
+
+class Service(object):
+
+    def __init__(self, session, name):
+        self.session = session
+        self.name = name
+
+    def sleep(self, seconds):
+        '''
+        Blocks like a long-running robot call, returning early if the call is cancelled.
+        '''
+        future = self.session.local.future
+        deadline = time.time() + seconds
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            if future is not None and future.isCancelRequested():
+                raise Cancelled()
+            time.sleep(min(remaining, 0.01))
+
+
+class ALMotion(Service):
+
+    def __init__(self, session, name):
+        Service.__init__(self, session, name)
+        self.lock = threading.Lock()
+        self.angles = dict(STANDING)
+        self.stiffness = dict((joint, 1.0) for joint in self.angles)
+        self.velocity = (0.0, 0.0, 0.0)
+        self.tasks = []  # (joints, future) of running interpolations
+        self.breathing = False
+
+    def expand(self, names):
+        if not isinstance(names, (list, tuple)):
+            names = [names]
+        joints = []
+        for name in names:
+            joints.extend(CHAINS.get(name, [name]))
+        return joints
+
+    @rpc
+    def getAngles(self, names, use_sensors):
+        with self.lock:
+            return [self.angles[joint] for joint in self.expand(names)]
+
+    @rpc
+    def setAngles(self, names, angles, fraction_max_speed):
+        joints = self.expand(names)
+        if not isinstance(angles, (list, tuple)):
+            angles = [angles] * len(joints)
+        with self.lock:
+            self.angles.update(zip(joints, angles))
+
+    @rpc
+    def angleInterpolation(self, names, angle_lists, time_lists, is_absolute):
+        joints = self.expand(names)
+        if not isinstance(angle_lists, (list, tuple)):
+            angle_lists, time_lists = [[angle_lists]], [[time_lists]]
+        elif len(joints) == 1 and not isinstance(angle_lists[0], (list, tuple)):
+            angle_lists, time_lists = [angle_lists], [time_lists]
+        with self.lock:
+            starts = [self.angles[joint] for joint in joints]
+        future = self.session.local.future
+        task = (set(joints), future)
+        with self.lock:
+            self.tasks.append(task)
+        try:
+            duration = max(times[-1] for times in time_lists)
+            begin = time.time()
+            while True:
+                elapsed = time.time() - begin
+                with self.lock:
+                    for joint, start, angles, times in zip(joints, starts, angle_lists, time_lists):
+                        self.angles[joint] = interpolate(start, angles, times, elapsed)
+                if elapsed >= duration:
+                    return
+                self.sleep(min(0.01, duration - elapsed))
+        finally:
+            with self.lock:
+                self.tasks.remove(task)
+
+    @rpc
+    def killTasksUsingResources(self, names):
+        joints = set(self.expand(names))
+        with self.lock:
+            for task_joints, future in self.tasks:
+                if future is not None and task_joints & joints:
+                    future.cancel()
+
+    @rpc
+    def killAll(self):
+        with self.lock:
+            for _, future in self.tasks:
+                if future is not None:
+                    future.cancel()
+
+    @rpc
+    def move(self, x, y, theta):
+        self.velocity = (x, y, theta)
+
+    @rpc
+    def stopMove(self):
+        self.velocity = (0.0, 0.0, 0.0)
+
+    @rpc
+    def getStiffnesses(self, names):
+        with self.lock:
+            return [self.stiffness[joint] for joint in self.expand(names)]
+
+    @rpc
+    def setStiffnesses(self, names, stiffness):
+        with self.lock:
+            for joint in self.expand(names):
+                self.stiffness[joint] = stiffness
+
+    @rpc
+    def stiffnessInterpolation(self, names, stiffness, seconds):
+        self.sleep(seconds)
+        with self.lock:
+            for joint in self.expand(names):
+                self.stiffness[joint] = stiffness
+
+    @rpc
+    def setBreathEnabled(self, chain, enabled):
+        self.breathing = enabled
+
+    @rpc
+    def wakeUp(self):
+        self.sleep(self.session.posture_seconds)
+        with self.lock:
+            self.angles.update(STANDING)
+            for joint in self.stiffness:
+                self.stiffness[joint] = 1.0
+
+    @rpc
+    def rest(self):
+        self.sleep(self.session.posture_seconds)
+        with self.lock:
+            for joint in self.stiffness:
+                self.stiffness[joint] = 0.0
+
+
+def interpolate(start, angles, times, elapsed):
+    '''
+    Angle at elapsed seconds along keyframes (times, angles) that start from start at 0 s.
+    '''
+    previous_time, previous_angle = 0.0, start
+    for t, angle in zip(times, angles):
+        if elapsed < t:
+            return previous_angle + (angle - previous_angle) * (elapsed - previous_time) / (t - previous_time)
+        previous_time, previous_angle = t, angle
+    return previous_angle
+
+
+class ALTextToSpeech(Service):
+
+    def __init__(self, session, name):
+        Service.__init__(self, session, name)
+        self.volume = 1.0
+        self.parameters = {}
+        self.speaking = []
+
+    @rpc
+    def say(self, text, *args):
+        future = self.session.local.future
+        self.speaking.append(future)
+        try:
+            self.sleep(self.session.speech_seconds_per_char * len(text))
+        finally:
+            self.speaking.remove(future)
+
+    @rpc
+    def stopAll(self):
+        for future in list(self.speaking):
+            if future is not None:
+                future.cancel()
+
+    @rpc
+    def setVolume(self, volume):
+        self.volume = volume
+
+    @rpc
+    def setParameter(self, name, value):
+        self.parameters[name] = value
+
+
+class ALAnimatedSpeech(ALTextToSpeech):
+    pass
+
+
+class ALRobotPosture(Service):
+
+    @rpc
+    def goToPosture(self, name, speed):
+        self.sleep(self.session.posture_seconds)
+        return True
+
+
+class ALLeds(Service):
+
+    @rpc
+    def fadeRGB(self, name, color, seconds):
+        self.sleep(seconds)
+
+
+class ALAutonomousLife(Service):
+
+    def __init__(self, session, name):
+        Service.__init__(self, session, name)
+        self.state = "disabled"
+
+    @rpc
+    def getState(self):
+        return self.state
+
+    @rpc
+    def setState(self, state):
+        self.state = state
+
+
+SERVICES = {
+    "ALMotion": ALMotion,
+    "ALTextToSpeech": ALTextToSpeech,
+    "ALAnimatedSpeech": ALAnimatedSpeech,
+    "ALRobotPosture": ALRobotPosture,
+    "ALLeds": ALLeds,
+    "ALAutonomousLife": ALAutonomousLife,
+}
+
+
+class Session(object):
+    '''
+    call_latency          -- seconds every call takes on top of its own work
+    posture_seconds       -- duration of wakeUp(), rest() and goToPosture()
+    speech_seconds_per_char -- how long say() takes per character of text
+    history               -- how many of the latest calls are kept in calls, report() counts every call
+    '''
+
+    def __init__(self, call_latency=0.002, posture_seconds=2.0, speech_seconds_per_char=0.06, history=10000):
+        self.call_latency = call_latency
+        self.posture_seconds = posture_seconds
+        self.speech_seconds_per_char = speech_seconds_per_char
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # (service, method, args, start, duration, error) of the latest calls, bounded for
+        # multi-hour replays: the joint cache alone calls getAngles 50 times a second
+        self.calls = deque(maxlen=history)
+        self.totals = {}  # (service, method) -> (count, total duration, longest duration)
+        self.services = {}
+
+    def connect(self, url):
+        pass
+
+    def service(self, name):
+        # a lookup is a round trip to the service directory
+        time.sleep(self.call_latency)
+        with self.lock:
+            if name not in self.services:
+                self.services[name] = SERVICES[name](self, name)
+            return self.services[name]
+
+    def invoke(self, service, method, args, kwargs, future):
+        start = time.time()
+        self.local.future = future
+        result, error = None, None
+        try:
+            time.sleep(self.call_latency)
+            result = method(service, *args, **kwargs)
+        except Cancelled:
+            error = RuntimeError("{}.{} cancelled".format(service.name, method.__name__))
+        except Exception as e:
+            error = e
+        finally:
+            self.local.future = None
+        with self.lock:
+            duration = time.time() - start
+            self.calls.append((service.name, method.__name__, args, start, duration, error))
+            count, total, longest = self.totals.get((service.name, method.__name__), (0, 0.0, 0.0))
+            self.totals[(service.name, method.__name__)] = (count + 1, total + duration, max(longest, duration))
+        if future is None:
+            if error is not None:
+                raise error
+            return result
+        future.result, future.error = result, error
+        future.done.set()
+
+    def report(self):
+        '''
+        Call count, mean and max duration per method.
+        '''
+        with self.lock:
+            totals = dict(self.totals)
+        lines = ["fake naoqi: {} calls".format(sum(count for count, _, _ in totals.values()))]
+        for (service, method), (count, total, longest) in sorted(totals.items()):
+            lines.append("  {:<40} {:>6} calls  mean {:8.1f} ms  max {:8.1f} ms".format(
+                service + "." + method, count, 1000 * total / count, 1000 * longest))
+        return "\n".join(lines)
@@ -0,0 +1,114 @@
+'''
+Gamepad state shared by the input loop (the only writer) and the sender
+thread, without locks. Must stay python 2.7 compatible.
+
+The state lives in two preallocated slots of AXES + BUTTONS values plus a
+version. The writer edits the back slot and publishes it by swapping a
+reference, then brings the other slot up to date with one slice
+assignment. A slot being edited has its version set to WRITING, so a
+reader that copied it mid-edit sees a version that is not the published
+one and copies again (a seqlock). Neither side ever waits for the other,
+so a stalled socket cannot delay joystick polling.
+
+Presses and change times go through deques, whose append and popleft are
+atomic, so a press is never lost between two snapshots.
+'''
+import threading
+from collections import deque
+from protocol import AXES, BUTTONS, BUTTON_BITS
+
+KEYS = AXES + BUTTONS
+INDEX = dict((key, i) for i, key in enumerate(KEYS))
+FIRST_BUTTON = len(AXES)
+VERSION = len(KEYS)  # index of the version in a slot
+WRITING = -1
+
+
+class InputState(object):
+
+    def __init__(self):
+        self.slots = [self.initial(), self.initial()]
+        self.back = 0
+        self.version = 0
+        self.front = self.slots[1]
+        # unbounded, they only grow while the sender is stuck reconnecting
+        self.changes = deque()  # time of every change not taken yet
+        self.presses = deque()  # (button, time) of every press not taken yet
+        self.changed = threading.Event()
+
+    @staticmethod
+    def initial():
+        return [0.0] * len(AXES) + [0] * len(BUTTONS) + [0]
+
+    ###########################
+    # Writer side
+    ###########################
+    def set(self, key, value, now):
+        '''
+        Sets one axis or button. A button set to 1 is always a press, even if it already was 1.
+        '''
+        slot = self.slots[self.back]
+        index = INDEX[key]
+        pressed = key in BUTTON_BITS and value
+        if slot[index] == value and not pressed:
+            return
+        slot[VERSION] = WRITING
+        slot[index] = value
+        if pressed:
+            self.presses.append((key, now))
+        self.changes.append(now)
+        self.publish()
+
+    def clear_buttons(self, now):
+        slot = self.slots[self.back]
+        if not any(slot[FIRST_BUTTON:VERSION]):
+            return
+        slot[VERSION] = WRITING
+        for index in range(FIRST_BUTTON, VERSION):
+            slot[index] = 0
+        self.changes.append(now)
+        self.publish()
+
+    def publish(self):
+        slot = self.slots[self.back]
+        self.version += 1
+        slot[VERSION] = self.version
+        self.front = slot
+        self.back ^= 1
+        self.slots[self.back][:] = slot
+        self.changed.set()
+
+    ###########################
+    # Reader side
+    ###########################
+    def snapshot(self, ev):
+        '''
+        Copies the published state into the dict ev and returns it.
+        '''
+        while True:
+            values = self.front[:]
+            if values[VERSION] == self.version:
+                break
+        for key, value in zip(KEYS, values):
+            ev[key] = value
+        return ev
+
+    def driving(self):
+        values = self.front
+        return any(values[:FIRST_BUTTON])
+
+    def take_changes(self):
+        '''
+        Time of the oldest change since the last call, or None.
+        '''
+        first = None
+        while self.changes:
+            now = self.changes.popleft()
+            first = now if first is None else first
+        return first
+
+    def take_presses(self):
+        presses = []
+        while self.presses:
+            presses.append(self.presses.popleft())
+        return presses
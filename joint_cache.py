@@ -0,0 +1,82 @@
+'''
+Background cache of joint angles. Must stay python 2.7 compatible.
+
+A sampler thread refreshes ALMotion.getAngles for a fixed set of joints at
+a configurable rate, so motion code can read the current pose without a
+blocking RPC. Reads older than the staleness bound, reads of joints that
+are not sampled, and explicitly fresh reads go to the robot instead.
+'''
+from __future__ import print_function
+import time
+import threading
+
+
+class JointStateCache(object):
+
+    def __init__(self, motion_service, names, rate=50.0, max_age=0.05):
+        self.motion_service = motion_service
+        self.names = list(names)
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+        self.period = 1.0 / rate
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.angles = None
+        self.stamp = 0.0
+        self.reset_stats()
+        thread = threading.Thread(target=self.loop)
+        thread.daemon = True  # Daemonize thread
+        thread.start()
+
+    def reset_stats(self):
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "fresh": 0,
+            "age_sum": 0.0,
+            "age_max": 0.0,
+        }
+
+    def loop(self):
+        while True:
+            start = time.time()
+            try:
+                self.refresh()
+            except Exception:
+                print("Unable to sample joint angles.")
+            time.sleep(max(0.0, self.period - (time.time() - start)))
+
+    def refresh(self):
+        angles = self.motion_service.getAngles(self.names, True)
+        with self.lock:
+            self.angles = angles
+            self.stamp = time.time()
+        return angles
+
+    def get(self, joints, max_age=None, fresh=False):
+        '''
+        Current angles of joints. Served from the cache if the last sample is at
+        most max_age seconds old (defaults to the cache's bound), unless fresh.
+        '''
+        if fresh:
+            with self.lock:
+                self.stats["fresh"] += 1
+            return self.motion_service.getAngles(joints, True)
+        max_age = self.max_age if max_age is None else max_age
+        with self.lock:
+            angles, age = self.angles, time.time() - self.stamp
+            if angles is not None and age <= max_age and all(joint in self.index for joint in joints):
+                self.stats["hits"] += 1
+                self.stats["age_sum"] += age
+                self.stats["age_max"] = max(self.stats["age_max"], age)
+                return [angles[self.index[joint]] for joint in joints]
+            self.stats["misses"] += 1
+        return self.motion_service.getAngles(joints, True)
+
+    def report(self):
+        with self.lock:
+            stats = self.stats
+            mean = stats["age_sum"] / stats["hits"] if stats["hits"] else 0.0
+            line = "joint cache: {} hits, {} misses, {} fresh reads, age mean {:.1f} ms max {:.1f} ms".format(
+                stats["hits"], stats["misses"], stats["fresh"], mean * 1000, stats["age_max"] * 1000)
+            self.reset_stats()
+        return line
@@ -0,0 +1,146 @@
+'''
+Rolling latency histograms. Must stay python 2.7 compatible.
+
+Values are bucketed HDR-style: exact below 64 us, above that 32 buckets
+per power of two, i.e. roughly 3% relative precision over any range
+with constant memory. RollingHistogram keeps one histogram per time
+slice and merges the slices of the last window on demand.
+
+PhaseTimer times the phases of a one-off sequence such as server startup.
+'''
+import time
+import threading
+from contextlib import contextmanager
+
+SUB_BUCKET_BITS = 6
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+HALF_BUCKETS = SUB_BUCKETS // 2
+
+
+def bucket_index(us):
+    if us < SUB_BUCKETS:
+        return us
+    shift = us.bit_length() - SUB_BUCKET_BITS
+    return shift * HALF_BUCKETS + (us >> shift)
+
+
+def bucket_value(index):
+    '''
+    Lower bound of a bucket, in microseconds.
+    '''
+    if index < SUB_BUCKETS:
+        return index
+    shift = index // HALF_BUCKETS - 1
+    return (index - shift * HALF_BUCKETS) << shift
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = {}
+        self.total = 0
+        self.max = 0.0
+
+    def record(self, seconds):
+        index = bucket_index(max(0, int(seconds * 1e6)))
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.total += 1
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        '''
+        Value at quantile q (0..1) in seconds, None if empty.
+        '''
+        if not self.total:
+            return None
+        rank = q * self.total
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(bucket_value(index) / 1e6, self.max)
+        return self.max
+
+
+class RollingHistogram(object):
+
+    def __init__(self, window=60.0, slices=6):
+        self.slice_length = window / slices
+        self.slices = slices
+        self.lock = threading.Lock()
+        self.history = []  # (slice start, Histogram), oldest first
+
+    def record(self, seconds, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            if not self.history or now - self.history[-1][0] >= self.slice_length:
+                self.history.append((now, Histogram()))
+                del self.history[:-self.slices]
+            self.history[-1][1].record(seconds)
+
+    def snapshot(self, now=None):
+        '''
+        Histogram of everything recorded within the window.
+        '''
+        now = time.time() if now is None else now
+        merged = Histogram()
+        with self.lock:
+            for start, histogram in self.history:
+                if now - start < self.slice_length * self.slices:
+                    merged.merge(histogram)
+        return merged
+
+
+def report(stages):
+    '''
+    One line per (name, RollingHistogram) stage with count, p50, p99 and max.
+    '''
+    lines = []
+    for name, rolling in stages:
+        histogram = rolling.snapshot()
+        if not histogram.total:
+            lines.append("{:<16} no samples".format(name))
+            continue
+        lines.append("{:<16} n={:<6} p50 {:7.1f} ms  p99 {:7.1f} ms  max {:7.1f} ms".format(
+            name, histogram.total, 1000 * histogram.percentile(0.5),
+            1000 * histogram.percentile(0.99), 1000 * histogram.max))
+    return "\n".join(lines)
+
+
+class PhaseTimer(object):
+    '''
+    Durations of named phases, which may run on different threads, and
+    milestones (time since start), reported on one line in recording order.
+    '''
+
+    def __init__(self, name, start=None):
+        self.name = name
+        self.start = time.time() if start is None else start
+        self.lock = threading.Lock()
+        self.entries = []  # (label, seconds, is_milestone)
+
+    @contextmanager
+    def phase(self, label):
+        started = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.entries.append((label, time.time() - started, False))
+
+    def mark(self, label):
+        with self.lock:
+            self.entries.append((label, time.time() - self.start, True))
+
+    def report(self):
+        with self.lock:
+            parts = ["{} at {:.0f} ms".format(label, 1000 * seconds) if milestone
+                     else "{} {:.0f} ms".format(label, 1000 * seconds)
+                     for label, seconds, milestone in self.entries]
+        return "{}: {}".format(self.name, ", ".join(parts))
@@ -0,0 +1,178 @@
+'''
+Loss/delay injection harness comparing the TCP and UDP axes channels on one machine.
+
+    python linksim.py --loss 0.05 --delay 0.02 --jitter 0.01
+
+A sender streams axes at 20 Hz through a local impaired link into a
+receiver that decodes them the way the robot server does. Every 5 ms the
+receiver samples how old its newest axis value is. Over TCP a lost segment
+is retransmitted after --rto and holds back everything behind it; over UDP
+the datagram is gone and the next one goes through.
+'''
+from __future__ import print_function
+import time
+import heapq
+import random
+import argparse
+import threading
+import protocol
+from socket import socket, AF_INET, SOCK_STREAM, SOCK_DGRAM
+
+
+class Link(object):
+    '''
+    Forwards payloads to send(payload) after a simulated network delay.
+    '''
+
+    def __init__(self, send, loss, delay, jitter, rto, ordered, seed=0):
+        self.send = send
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.rto = rto
+        self.ordered = ordered
+        self.rng = random.Random(seed)
+        self.cond = threading.Condition()
+        self.queue = []  # heap of (release_at, n, payload)
+        self.count = 0
+        self.last_release = 0.0
+        self.lost = 0
+        thread = threading.Thread(target=self.loop)
+        thread.daemon = True  # Daemonize thread
+        thread.start()
+
+    def put(self, payload):
+        release_at = time.time() + self.delay + self.rng.uniform(0, self.jitter)
+        if self.rng.random() < self.loss:
+            self.lost += 1
+            if not self.ordered:
+                return
+            # TCP: resent after the retransmission timeout
+            release_at += self.rto
+        if self.ordered:
+            # TCP: nothing overtakes a segment that is still in flight
+            release_at = max(release_at, self.last_release)
+            self.last_release = release_at
+        with self.cond:
+            self.count += 1
+            heapq.heappush(self.queue, (release_at, self.count, payload))
+            self.cond.notify()
+
+    def loop(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                release_at, _, payload = self.queue[0]
+                wait = release_at - time.time()
+                if wait > 0:
+                    self.cond.wait(wait)
+                    continue
+                heapq.heappop(self.queue)
+            self.send(payload)
+
+
+class Receiver(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.newest_stamp = None
+        self.last_seq = None
+        self.updates = 0
+        self.stale = 0
+
+    def apply(self, seq, stamp):
+        with self.lock:
+            if seq is not None and not protocol.seq_newer(seq, self.last_seq):
+                self.stale += 1
+                return
+            self.last_seq = seq
+            self.newest_stamp = stamp
+            self.updates += 1
+
+    def age(self, now):
+        with self.lock:
+            return None if self.newest_stamp is None else now - self.newest_stamp
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def run(mode, args):
+    receiver = Receiver()
+    if mode == "tcp":
+        server = socket(AF_INET, SOCK_STREAM)
+        server.bind(("127.0.0.1", 0))
+        server.listen(1)
+        sender = socket(AF_INET, SOCK_STREAM)
+        sender.connect(server.getsockname())
+        inbound, _ = server.accept()
+        protocol.tune_socket(sender)
+        protocol.tune_socket(inbound)
+
+        def deliver():
+            framer = protocol.Framer(protocol.PROTOCOL_BINARY)
+            while framer.recv_from(inbound):
+                for frame in framer.frames():
+                    _, stamp, _, _ = protocol.decode_frame(framer.protocol, frame)
+                    receiver.apply(None, stamp)  # TCP is ordered, no stale frames
+
+        link = Link(sender.sendall, args.loss, args.delay, args.jitter, args.rto, True, args.seed)
+        encode = lambda seq, stamp: protocol.encode_binary(protocol.empty_ev(), seq, stamp)
+    else:
+        inbound = socket(AF_INET, SOCK_DGRAM)
+        inbound.bind(("127.0.0.1", 0))
+        sender = socket(AF_INET, SOCK_DGRAM)
+        address = inbound.getsockname()
+
+        def deliver():
+            while True:
+                data, _ = inbound.recvfrom(64)
+                seq, stamp, _, _ = protocol.decode_axes(data)
+                receiver.apply(seq, stamp)
+
+        link = Link(lambda payload: sender.sendto(payload, address), args.loss, args.delay, args.jitter,
+                    args.rto, False, args.seed)
+        encode = lambda seq, stamp: protocol.encode_axes(seq, stamp, 0.0, 0.0)
+
+    thread = threading.Thread(target=deliver)
+    thread.daemon = True  # Daemonize thread
+    thread.start()
+
+    ages = []
+    start = time.time()
+    next_send = start
+    next_sample = start
+    seq = 0
+    while time.time() - start < args.seconds:
+        now = time.time()
+        if now >= next_send:
+            seq += 1
+            link.put(encode(seq, now))
+            next_send += 1.0 / args.rate
+        if now >= next_sample:
+            age = receiver.age(now)
+            if age is not None:
+                ages.append(age)
+            next_sample += 0.005
+        time.sleep(0.001)
+
+    print("{:<4} sent {:>5}  lost {:>4}  applied {:>5}  stale {:>4}  axis age p50 {:6.1f} ms  p99 {:6.1f} ms  max {:6.1f} ms".format(
+        mode, seq, link.lost, receiver.updates, receiver.stale,
+        1000 * percentile(ages, 0.5), 1000 * percentile(ages, 0.99), 1000 * max(ages)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--loss", type=float, default=0.05, help="packet loss probability")
+    parser.add_argument("--delay", type=float, default=0.02, help="one-way delay in seconds")
+    parser.add_argument("--jitter", type=float, default=0.01, help="extra random delay in seconds")
+    parser.add_argument("--rto", type=float, default=0.2, help="TCP retransmission timeout in seconds")
+    parser.add_argument("--rate", type=float, default=20.0, help="frames per second")
+    parser.add_argument("--seconds", type=float, default=5.0, help="duration of each run")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    for mode in ("tcp", "udp"):
+        run(mode, args)
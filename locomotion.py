@@ -0,0 +1,159 @@
+'''
+Fixed-rate velocity controller for the base. Must stay python 2.7 compatible.
+
+Frames only set a target velocity. The controller's own thread ramps the
+commanded velocity toward it every 1/rate seconds, within the acceleration
+and deceleration limits, and calls move() only when the command changed by
+more than threshold on some axis since the last call. Frames that arrive
+bunched up by network jitter therefore do not reach the base as steps, and
+a joystick held still costs no RPCs at all. Reaching zero is always sent
+exactly, and stop() bypasses the ramp for emergency stops.
+
+Velocities are (forward m/s, yaw rad/s), as in ALMotion.move(x, 0, theta).
+'''
+from __future__ import print_function
+import time
+import threading
+import traceback
+
+
+class LocomotionController(object):
+
+    def __init__(self, move, rate=50.0, accel=(0.8, 2.0), decel=(1.6, 4.0), threshold=(0.01, 0.02),
+                 histogram=None):
+        '''
+        move -- called as move(forward, yaw) from the controller thread
+        accel, decel -- per axis limits in units per second squared
+        threshold -- smallest change per axis worth a move() call
+        histogram -- optional latency.RollingHistogram of the time from a new
+                     target until the first move() towards it returns
+        '''
+        self.move = move
+        self.period = 1.0 / rate
+        self.accel = accel
+        self.decel = decel
+        self.threshold = threshold
+        self.histogram = histogram
+        self.lock = threading.Lock()  # held while commanding, so stop() is never overtaken
+        self.target = (0.0, 0.0)
+        self.target_at = None  # when the target changed, until a move() reflects it
+        self.current = (0.0, 0.0)
+        self.sent = (0.0, 0.0)
+        self.wake = threading.Event()
+        self.reset_stats()
+        thread = threading.Thread(target=self.loop)
+        thread.daemon = True  # Daemonize thread
+        thread.start()
+
+    def reset_stats(self):
+        self.stats = {
+            "targets": 0,
+            "per_frame": 0,  # move() calls of one call per frame while driving
+            "moves": 0,
+            "stops": 0,
+            "since": time.time(),
+        }
+
+    def set_target(self, forward, yaw, now=None):
+        '''
+        Called for every received frame. Cheap, it never calls the robot.
+        '''
+        target = (forward, yaw)
+        with self.lock:
+            self.stats["targets"] += 1
+            changed = target != self.target
+            if target != (0.0, 0.0) or self.target != (0.0, 0.0):
+                self.stats["per_frame"] += 1
+            if changed:
+                self.target = target
+                if self.target_at is None:
+                    self.target_at = time.time() if now is None else now
+        if changed:
+            self.wake.set()
+
+    def stop(self):
+        '''
+        Stops the base now, without ramping down.
+        '''
+        with self.lock:
+            self.target = self.current = (0.0, 0.0)
+            self.target_at = None
+            self.stats["stops"] += 1
+            self.command((0.0, 0.0))
+
+    def moving(self):
+        return self.target != (0.0, 0.0) or self.sent != (0.0, 0.0)
+
+    def loop(self):
+        next_tick = time.time()
+        while True:
+            with self.lock:
+                settled = self.current == self.target and not self.pending()
+                if settled:
+                    # a target within threshold of the command needs no move()
+                    self.target_at = None
+            if settled:
+                # nothing to ramp, sleep until the next target
+                self.wake.wait()
+                next_tick = time.time()
+            self.wake.clear()
+            try:
+                self.tick()
+            except Exception:
+                print("Error encountered in locomotion controller.")
+                traceback.print_exc()
+            next_tick += self.period
+            delay = next_tick - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_tick = time.time()
+
+    def tick(self):
+        with self.lock:
+            self.current = tuple(self.ramp(axis) for axis in range(2))
+            if self.pending():
+                self.command(self.current)
+
+    def ramp(self, axis):
+        current, target = self.current[axis], self.target[axis]
+        # slowing down (or reversing through zero) uses the deceleration limit
+        speeding_up = abs(target) > abs(current) and target * current >= 0
+        limit = (self.accel if speeding_up else self.decel)[axis] * self.period
+        if abs(target - current) <= limit:
+            return target
+        return current + limit if target > current else current - limit
+
+    def pending(self):
+        '''
+        Whether the command differs enough from the last move() to send it. Caller must hold self.lock.
+        '''
+        if self.current == self.sent:
+            return False
+        if self.current == (0.0, 0.0):
+            return True
+        return any(abs(c - s) > t for c, s, t in zip(self.current, self.sent, self.threshold))
+
+    def command(self, velocity):
+        '''
+        Caller must hold self.lock.
+        '''
+        self.move(*velocity)
+        self.sent = velocity
+        self.stats["moves"] += 1
+        if self.target_at is not None:
+            if self.histogram is not None:
+                self.histogram.record(time.time() - self.target_at)
+            self.target_at = None
+
+    def report(self):
+        with self.lock:
+            stats = self.stats
+            elapsed = max(time.time() - stats["since"], 1e-9)
+            saved = max(0, stats["per_frame"] - stats["moves"])
+            line = ("locomotion: {} targets, {} move calls ({} stops) instead of {}, {} saved ({:.1f}/s), "
+                    "commanding {:.2f} m/s {:.2f} rad/s").format(
+                stats["targets"], stats["moves"], stats["stops"], stats["per_frame"], saved, saved / elapsed,
+                self.sent[0], self.sent[1])
+            self.reset_stats()
+        return line
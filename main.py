@@ -1,92 +1,267 @@
-import sys
+import os
 import time
 import pygame
 import select
+import argparse
 import threading
-import json
-from socket import socket, AF_INET, SOCK_STREAM
+import protocol
+import session_log
+import mapping
+import shm_channel
+from input_state import InputState
+from socket import socket, AF_INET, SOCK_STREAM, SOCK_DGRAM
 
 
 class Client:
 
-    def __init__(self):
+    def __init__(self, ip, udp=False, record=None, max_rate=100.0, heartbeat=protocol.IDLE_HEARTBEAT, shm=False):
         self.s = None
-        self.event_ds_lock = threading.Lock()
-        self.ev = {
-            "velocity": 0.0,
-            "twist": 0.0,
-            "a": 0,
-            "b": 0,
-            "x": 0,
-            "y": 0,
-            "lb": 0,
-            "rb": 0,
-            "info": 0,
-            "start": 0,
-            "center": 0,
-            "left joy button": 0,
-            "right joy button": 0,
-            "up": 0,
-            "down": 0,
-            "left": 0,
-            "right": 0
-        }
-        self.connect_to_robot(sys.argv[1])
+        # optional log of every sent frame, see session_log.py
+        self.session_log = session_log.SessionLog(record) if record else None
+        self.protocol = protocol.PROTOCOL_JSON
+        # optional UDP channel for the axes, see protocol.py
+        self.use_udp = udp
+        self.udp = socket(AF_INET, SOCK_DGRAM) if udp else None
+        self.udp_port = None
+        # optional shared-memory channel, asked for when the robot runs on this host, see shm_channel.py.
+        # Off by default: the server polls it every millisecond, which is slower than loopback TCP
+        self.use_shm = shm
+        self.shm = None
+        # set by receive_replies when the robot closes the connection, so the sender
+        # reconnects at once rather than on its next TCP send, a heartbeat away with shared memory
+        self.closed = threading.Event()
+        self.seq = 0
+        # round trip times, see receive_replies
+        self.ping_id = 0
+        self.last_ping = 0.0
+        self.rtts = []
+        # frames go out as soon as the input changes, at most max_rate per second,
+        # and repeat every heartbeat seconds when nothing changes
+        self.min_interval = 1.0 / max_rate
+        self.heartbeat = min(heartbeat, protocol.SILENCE_TIMEOUT / 2)
+        # written by the gamepad loop, read by the sender, see input_state.py
+        self.input = InputState()
+        self.ev = protocol.empty_ev()  # the sender's copy of the input state
+        # how late the gamepad loop ran, see record_input_delay
+        self.reset_input_stats()
+        # with PROTOCOL_EVENTS every press is also sent as an event until the robot acknowledges it
+        self.presses = protocol.PressQueue()
+        self.press_lock = threading.Lock()
+        self.connect_to_robot(ip)
         thread = threading.Thread(target=self.send_ev_ds)
         thread.daemon = True        # Daemonize thread
         thread.start()
 
     def connect_to_robot(self, ip):
+        self.ip = ip
+        if self.shm is not None:
+            self.shm.close()
+            self.shm = None
+        delay = 0.05
+        start = time.time()
         while True:
             try:
                 self.s = socket(AF_INET, SOCK_STREAM)
                 self.s.connect((ip, 8888))
+                protocol.tune_socket(self.s)
+                self.protocol, self.udp_port, shm_path = self.negotiate_protocol()
+                if shm_path is not None:
+                    try:
+                        self.shm = shm_channel.ShmChannel.open(shm_path)
+                    except (EnvironmentError, ValueError):
+                        # e.g. the server runs as another user, ask again without it
+                        print("Unable to open shared memory at {}, reconnecting without it.".format(shm_path))
+                        self.use_shm = False
+                        raise
+                with self.press_lock:
+                    self.presses.resend()
+                # whatever protocol was negotiated, the new connection is open
+                self.closed.clear()
                 break
             except:
+                self.s.close()
                 print("Unable to connect to robot at {}:8888. Is server running?".format(ip))
-            time.sleep(1)
+            # retry quickly at first so a short drop reconnects in well under a second
+            time.sleep(delay)
+            delay = min(1.0, delay * 2)
+        print("Connected in {:.0f} ms using wire protocol {}{}{}".format(
+            1000 * (time.time() - start), self.protocol, " and UDP axes" if self.udp_port else "",
+            " and shared memory" if self.shm is not None else ""))
+        if self.protocol >= protocol.PROTOCOL_STAMPED:
+            thread = threading.Thread(target=self.receive_replies, args=(self.s,))
+            thread.daemon = True        # Daemonize thread
+            thread.start()
+
+    def negotiate_protocol(self):
+        '''
+        Offer the binary protocol. Old servers never answer, in which case we keep speaking JSON.
+        Returns (protocol, udp_port, shm_path).
+        '''
+        shm = self.use_shm and shm_channel.is_loopback(self.ip)
+        self.s.send(protocol.hello(self.use_udp, self.presses.session, shm=shm))
+        reply = b''
+        deadline = time.time() + protocol.HELLO_TIMEOUT
+        while b'\n' not in reply:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return protocol.PROTOCOL_JSON, None, None
+            read_s, _, _ = select.select([self.s], [], [], remaining)
+            if not read_s:
+                return protocol.PROTOCOL_JSON, None, None
+            chunk = self.s.recv(64)
+            if not chunk:
+                # a closed connection is a failed connect, not an old server
+                raise IOError("Connection closed during the handshake")
+            reply += chunk
+        return protocol.parse_accept(reply.split(b'\n')[0].decode())
+
+    def wait_for_send(self, last_send):
+        '''
+        Blocks until the next frame is due.
+        '''
+        while True:
+            if self.input.changed.is_set():
+                remaining = last_send + self.min_interval - time.time()
+                if remaining <= 0:
+                    return
+                time.sleep(remaining)
+                continue
+            # keep the robot's watchdog fed while driving
+            heartbeat = protocol.DRIVING_HEARTBEAT if self.input.driving() else self.heartbeat
+            remaining = last_send + heartbeat - time.time()
+            if remaining <= 0:
+                return
+            self.input.changed.wait(remaining)
 
     def send_ev_ds(self):
+        last_send = 0.0
+        last_tcp_send = 0.0
         while True:
-            time.sleep(0.05)  # 20 hz
-            self.event_ds_lock.acquire()
-            s = json.dumps(self.ev) + "\n"
+            self.wait_for_send(last_send)
+            # cleared before the snapshot, so any later change wakes us again
+            self.input.changed.clear()
+            ev = self.input.snapshot(self.ev)
+            self.seq += 1
+            stamp = time.time()
+            last_send = stamp
+            input_since = self.input.take_changes()
+            input_age = None if input_since is None else stamp - input_since
+            presses = self.input.take_presses()
+            for button, _ in presses:
+                # pressed since the last frame, sent even if released in between
+                ev[button] = 1
+            s = protocol.encode(self.protocol, ev, self.seq, stamp, input_age)
+            if self.session_log is not None:
+                self.session_log.write(ev, self.seq, stamp, input_age, stamp)
+            with self.press_lock:
+                for button, pressed_at in presses:
+                    self.presses.press(button, pressed_at)
+                if self.protocol >= protocol.PROTOCOL_EVENTS:
+                    events = self.presses.take()
+                    if self.shm is not None:
+                        # whatever does not fit into the ring goes with the next frame
+                        left = self.shm.push_presses(events)
+                        self.presses.unsend(len(left) // protocol.PRESS_STRUCT.size)
+                    else:
+                        s += events
+                else:
+                    # older servers only see the button bits
+                    self.presses.discard()
+            if self.shm is not None:
+                self.shm.write_axes(self.seq, stamp, ev["velocity"], ev["twist"], input_age)
+                if stamp - last_tcp_send < self.heartbeat and not self.closed.is_set():
+                    # TCP only keeps the connection alive and carries the pings
+                    continue
+            if self.protocol >= protocol.PROTOCOL_STAMPED and stamp - self.last_ping >= 1.0:
+                self.ping_id += 1
+                self.last_ping = stamp
+                s += protocol.encode_ping(self.ping_id, stamp)
+            if self.udp_port:
+                # best effort, a lost datagram is superseded by the next one
+                try:
+                    self.udp.sendto(protocol.encode_axes(self.seq, stamp, ev["velocity"], ev["twist"]),
+                                    (self.ip, self.udp_port))
+                except:
+                    pass
             try:
+                if self.closed.is_set():
+                    raise IOError("Connection closed by the robot")
                 read_s, write_s, exceptional = select.select([], [self.s], [])
-                write_s[0].send(str.encode(s))
+                write_s[0].send(s)
+                last_tcp_send = stamp
             except:
-                print("not connected yet")
-            self.event_ds_lock.release()
+                print("Lost connection to robot. Reconnecting...")
+                self.s.close()
+                self.connect_to_robot(self.ip)
+                last_send = 0.0
+                last_tcp_send = 0.0
+
+    def receive_replies(self, sock):
+        '''
+        Reads press acknowledgements and answers to our pings on sock until the connection closes,
+        printing the RTT every 10 s.
+        '''
+        framer = protocol.Framer(self.protocol)
+        try:
+            while framer.recv_from(sock):
+                for frame in framer.frames():
+                    if protocol.message_type(frame) == protocol.ACK_MAGIC:
+                        with self.press_lock:
+                            self.presses.ack(protocol.decode_ack(frame))
+                        continue
+                    if protocol.message_type(frame) != protocol.PONG_MAGIC:
+                        continue
+                    _, sent, _ = protocol.decode_pong(frame)
+                    self.rtts.append(time.time() - sent)
+                    if len(self.rtts) >= 10:
+                        print("RTT to robot: last {:.1f} ms, min {:.1f} ms, max {:.1f} ms".format(
+                            1000 * self.rtts[-1], 1000 * min(self.rtts), 1000 * max(self.rtts)))
+                        self.rtts = []
+        except:
+            pass
+        if sock is self.s:
+            self.closed.set()
+            self.input.changed.set()
 
     def reset_event_ds_buttons(self):
-        self.event_ds_lock.acquire()
-        self.ev = {
-            "velocity": self.ev["velocity"],
-            "twist": self.ev["twist"],
-            "a": 0,
-            "b": 0,
-            "x": 0,
-            "y": 0,
-            "lb": 0,
-            "rb": 0,
-            "info": 0,
-            "start": 0,
-            "center": 0,
-            "left joy button": 0,
-            "right joy button": 0,
-            "up": 0,
-            "down": 0,
-            "left": 0,
-            "right": 0
-        }
-        self.event_ds_lock.release()
+        self.input.clear_buttons(time.time())
 
     def update_event_ds(self, key, val):
-        self.event_ds_lock.acquire()
-        self.ev[key] = val
-        self.event_ds_lock.release()
+        self.input.set(key, val, time.time())
 
-    def gamepad_loop(self):
+    def reset_input_stats(self):
+        self.input_stats = {
+            "ticks": 0,
+            "late": 0,
+            "delay_sum": 0.0,
+            "delay_max": 0.0,
+        }
+        self.last_input_report = time.time()
+
+    def record_input_delay(self, delay, late=0.005, report_interval=60.0):
+        '''
+        Counts how far a gamepad loop tick ran behind schedule, printing the stats every report_interval.
+        '''
+        stats = self.input_stats
+        stats["ticks"] += 1
+        stats["delay_sum"] += delay
+        stats["delay_max"] = max(stats["delay_max"], delay)
+        if delay > late:
+            stats["late"] += 1
+        if time.time() - self.last_input_report >= report_interval:
+            print(self.input_report())
+            self.reset_input_stats()
+
+    def input_report(self):
+        stats = self.input_stats
+        mean = stats["delay_sum"] / stats["ticks"] if stats["ticks"] else 0.0
+        return "input loop: {} ticks, {} late by over 5 ms, delay mean {:.1f} ms max {:.1f} ms".format(
+            stats["ticks"], stats["late"], mean * 1000, stats["delay_max"] * 1000)
+
+    def gamepad_loop(self, mapping, poll_rate=100.0):
+        '''
+        Polls pygame poll_rate times per second and translates events through mapping (see mapping.py).
+        '''
         pygame.init()
         joysticks = []
         clock = pygame.time.Clock()
@@ -96,83 +271,59 @@ class Client:
         for i in range(0, pygame.joystick.get_count()):
             joysticks.append(pygame.joystick.Joystick(i))
             joysticks[-1].init()
-            print ("Detected joystick "), joysticks[-1].get_name()
-        print('Listening for commands...')
+            print("Detected joystick {}".format(joysticks[-1].get_name()))
+        print('Listening for commands at {:.0f} Hz...'.format(poll_rate))
+        period = 1.0 / poll_rate
+        last_tick = None
+        # bound once, the loop below runs up to 250 times a second
+        axes = mapping.axes
+        buttons = mapping.buttons
+        hats = mapping.hats
+        keys = mapping.keys
+        button_event = pygame.JOYBUTTONUP if mapping.button_event == "up" else pygame.JOYBUTTONDOWN
+        update = self.update_event_ds
         while keepPlaying:
-            clock.tick(20)
+            clock.tick(poll_rate)
+            now = time.time()
+            if last_tick is not None:
+                self.record_input_delay(max(0.0, now - last_tick - period))
+            last_tick = now
             self.reset_event_ds_buttons()
             for event in pygame.event.get():
-                if event.type == pygame.KEYDOWN:
-                    if event.unicode == 'w':
-                        print('w')
-                        self.update_event_ds('up', 1)
-                    elif event.unicode == 'a':
-                        print('a')
-                        self.update_event_ds('left', 1)
-                    elif event.unicode == 's':
-                        print('s')
-                        self.update_event_ds('down', 1)
-                    elif event.unicode == 'd':
-                        print('d')
-                        self.update_event_ds('right', 1)
-                if event.type == pygame.JOYAXISMOTION:
-                    if event.axis == 1 and event.value > 0:
-                        self.update_event_ds("velocity", -1 * event.value if event.value > 0.2 else 0.0)
-                    elif event.axis == 1:
-                        self.update_event_ds("velocity", -1 * event.value if event.value < -0.2 else 0.0)
-                    if event.axis == 3 and event.value > 0:
-                        self.update_event_ds("twist", -1 * event.value if event.value > 0.2 else 0.0)
-                    elif event.axis == 3:
-                        self.update_event_ds("twist", -1 * event.value if event.value < -0.2 else 0.0)
-                elif event.type == pygame.JOYBUTTONUP:
-                    if event.button == 0:
-                        print("a")
-                        self.update_event_ds("a", 1)
-                    if event.button == 1:
-                        print("b")
-                        self.update_event_ds("b", 1)
-                    if event.button == 2:
-                        print("x")
-                        self.update_event_ds("x", 1)
-                    if event.button == 3:
-                        print("y")
-                        self.update_event_ds("y", 1)
-                    if event.button == 4:
-                        print("lb")
-                        self.update_event_ds("lb", 1)
-                    if event.button == 5:
-                        print("rb")
-                        self.update_event_ds("rb", 1)
-                    if event.button == 6:
-                        print("info")
-                        self.update_event_ds("info", 1)
-                    if event.button == 7:
-                        print("start")
-                        self.update_event_ds("start", 1)
-                    if event.button == 8:
-                        print("center")
-                        self.update_event_ds("center", 1)
-                    if event.button == 9:
-                        print("left joy button")
-                        self.update_event_ds("left joy button", 1)
-                    if event.button == 10:
-                        print("right joy button")
-                        self.update_event_ds("right joy button", 1)
-                elif event.type == pygame.JOYHATMOTION:
-                    val = None
-                    if event.value[0] == 1:
-                        val = "right"
-                    elif event.value[0] == -1:
-                        val = "left"
-                    elif event.value[1] == 1:
-                        val = "up"
-                    elif event.value[1] == -1:
-                        val = "down"
-                    if val is not None:
-                        print(val)
-                        self.update_event_ds(val, 1)
-
-                        
+                kind = event.type
+                if kind == pygame.JOYAXISMOTION:
+                    axis = axes.get(event.axis)
+                    if axis is not None:
+                        update(axis[0], axis[1](event.value))
+                elif kind == button_event:
+                    name = buttons.get(event.button)
+                    if name is not None:
+                        update(name, 1)
+                elif kind == pygame.JOYHATMOTION:
+                    name = hats.get((event.hat, event.value))
+                    if name is not None:
+                        update(name, 1)
+                elif kind == pygame.KEYDOWN:
+                    name = keys.get(event.unicode)
+                    if name is not None:
+                        update(name, 1)
+
+
 if __name__ == "__main__":
-    client = Client()
-    client.gamepad_loop()
+    parser = argparse.ArgumentParser(description="Drive Pepper with a gamepad.")
+    parser.add_argument("ip", help="robot IP address")
+    parser.add_argument("--udp", action="store_true", help="send the joystick axes over UDP")
+    parser.add_argument("--record", metavar="LOG", help="append every sent frame to this session log")
+    parser.add_argument("--max-rate", type=float, default=100.0, help="most frames per second sent on input changes")
+    parser.add_argument("--heartbeat", type=float, default=protocol.IDLE_HEARTBEAT,
+                        help="seconds between repeated frames while idle (at most {})".format(protocol.SILENCE_TIMEOUT / 2))
+    parser.add_argument("--mapping", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "gamepad.json"),
+                        help="button, axis, hat and key mapping, see mapping.py")
+    parser.add_argument("--shm", action="store_true",
+                        help="send the axes and presses through shared memory when the robot server runs on this host")
+    parser.add_argument("--poll-rate", type=float, default=100.0, help="gamepad polls per second (at most 250)")
+    args = parser.parse_args()
+    gamepad = mapping.load(args.mapping)
+    client = Client(args.ip, udp=args.udp, record=args.record, max_rate=args.max_rate, heartbeat=args.heartbeat,
+                    shm=args.shm)
+    client.gamepad_loop(gamepad, min(args.poll_rate, 250.0))
@@ -0,0 +1,91 @@
+'''
+Gamepad and keyboard mapping, loaded from a JSON file and compiled into
+dict lookups for the input loop. gamepad.json maps an XBox One controller:
+
+    {
+      "button_event": "up",                     # trigger on release ("up") or press ("down")
+      "buttons": {"0": "a", ...},               # joystick button number -> button
+      "keys": {"w": "up", ...},                 # typed character -> button
+      "hats": {"0": {"up": [0, 1], ...}},       # hat number -> button -> hat position
+      "deadzone": 0.2,                          # default for every axis
+      "axes": {"1": {"name": "velocity", "scale": -1.0, "curve": "linear"}, ...}
+    }
+
+An axis reads 0 inside its deadzone. Outside it, the magnitude is raised to
+the curve's exponent ("linear", "quadratic", "cubic" or a number). With
+"rescale" it first maps deadzone..1 onto 0..1, so the output does not jump
+at the deadzone edge. The result is multiplied by "scale".
+'''
+import json
+import itertools
+from protocol import AXES, BUTTONS
+
+CURVES = {"linear": 1.0, "quadratic": 2.0, "cubic": 3.0}
+
+
+def axis_response(scale=1.0, deadzone=0.2, curve="linear", rescale=False):
+    '''
+    Returns a function from a raw axis value in -1..1 to the value sent to the robot.
+    '''
+    exponent = float(CURVES.get(curve, curve))
+    span = 1.0 - deadzone
+
+    def response(value):
+        magnitude = abs(value)
+        if magnitude <= deadzone:
+            return 0.0
+        if rescale:
+            magnitude = min(1.0, (magnitude - deadzone) / span)
+        if exponent != 1.0:
+            magnitude = magnitude ** exponent
+        return scale * magnitude if value > 0 else -scale * magnitude
+    return response
+
+
+def compile_hat(directions):
+    '''
+    {button: [x, y]} to {(x, y): button} over all nine hat positions. On a
+    diagonal the horizontal direction wins.
+    '''
+    by_position = dict((tuple(position), name) for name, position in directions.items())
+    compiled = {}
+    for x, y in itertools.product((-1, 0, 1), repeat=2):
+        name = by_position.get((x, y)) or by_position.get((x, 0)) or by_position.get((0, y))
+        if name is not None:
+            compiled[(x, y)] = name
+    return compiled
+
+
+def check_button(name):
+    if name not in BUTTONS:
+        raise ValueError("Unknown button {!r}, expected one of {}".format(name, ", ".join(BUTTONS)))
+    return name
+
+
+class Mapping(object):
+
+    def __init__(self, config):
+        self.button_event = config.get("button_event", "up")
+        if self.button_event not in ("up", "down"):
+            raise ValueError("button_event must be 'up' or 'down'")
+        self.buttons = dict((int(number), check_button(name)) for number, name in config.get("buttons", {}).items())
+        self.keys = dict((key, check_button(name)) for key, name in config.get("keys", {}).items())
+        self.hats = {}
+        for hat, directions in config.get("hats", {}).items():
+            for name in directions:
+                check_button(name)
+            for position, name in compile_hat(directions).items():
+                self.hats[(int(hat), position)] = name
+        self.axes = {}
+        deadzone = config.get("deadzone", 0.2)
+        for axis, spec in config.get("axes", {}).items():
+            if spec["name"] not in AXES:
+                raise ValueError("Unknown axis {!r}, expected one of {}".format(spec["name"], ", ".join(AXES)))
+            self.axes[int(axis)] = (spec["name"], axis_response(
+                spec.get("scale", 1.0), spec.get("deadzone", deadzone), spec.get("curve", "linear"),
+                spec.get("rescale", False)))
+
+
+def load(path):
+    with open(path) as f:
+        return Mapping(json.load(f))
@@ -0,0 +1,106 @@
+'''
+Pose library for posture(), head() and arm(). Must stay python 2.7 compatible.
+
+Poses are read once from a JSON file of kind -> pose name -> joint -> value,
+in degrees except for the hands, which take an opening between 0 and 1:
+
+    {
+      "posture": {"Standing": {"HeadPitch": -11.1, ..., "LHand": 0.6, ...}, ...},
+      "arm": {"Left Extended": {"LWristYaw": -81.2, ...}, ...},
+      "head": {"Up": {"HeadPitch": -40.5}, ...}
+    }
+
+and compiled into one (poses x joints) array of radians plus a mask of the
+joints each pose sets. A lookup is a dict access returning precomputed rows.
+A blend such as {"Welcoming": 0.3, "Standing": 0.7} is a single weighted
+sum over the rows; each joint is averaged over the poses that set it.
+'''
+import json
+from collections import OrderedDict
+import numpy as np
+
+# joints set in raw units rather than degrees
+UNSCALED_JOINTS = ("LHand", "RHand")
+
+
+class PoseLibrary(object):
+
+    def __init__(self, joints, config):
+        '''
+        joints -- every joint a pose may set, in column order
+        '''
+        self.joints = list(joints)
+        columns = dict((joint, i) for i, joint in enumerate(self.joints))
+        scale = np.array([1.0 if joint in UNSCALED_JOINTS else np.pi / 180 for joint in self.joints])
+        self.names = []
+        self.kinds = {}
+        for kind, poses in config.items():
+            for name in poses:
+                if name in self.kinds:
+                    raise ValueError("Pose {!r} is defined twice".format(name))
+                self.kinds[name] = kind
+                self.names.append(name)
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+
+        self.angles = np.zeros((len(self.names), len(self.joints)))
+        self.mask = np.zeros((len(self.names), len(self.joints)), dtype=bool)
+        for kind, poses in config.items():
+            for name, values in poses.items():
+                for joint, value in values.items():
+                    if joint not in columns:
+                        raise ValueError("Pose {!r} sets unknown joint {!r}".format(name, joint))
+                    self.angles[self.index[name], columns[joint]] = value
+                    self.mask[self.index[name], columns[joint]] = True
+        self.angles *= scale
+        self.angles.flags.writeable = False
+        self.mask.flags.writeable = False
+
+        # (joints, angles) of every pose, in the library's joint order
+        self.targets = {}
+        for name, row in self.index.items():
+            cols = np.flatnonzero(self.mask[row])
+            self.targets[name] = ([self.joints[col] for col in cols], self.angles[row, cols])
+
+    def check(self, name, kind=None):
+        if name not in self.index or (kind is not None and self.kinds[name] != kind):
+            known = sorted(n for n in self.names if kind is None or self.kinds[n] == kind)
+            raise ValueError("Unknown {}pose {!r}, expected one of {}".format(kind + " " if kind else "", name, ", ".join(known)))
+
+    def lookup(self, name, kind=None):
+        '''
+        (joints, angles) of a pose, angles in radians.
+        '''
+        self.check(name, kind)
+        return self.targets[name]
+
+    def blend(self, weights, kind=None):
+        '''
+        (joints, angles) for {pose: weight}, setting every joint that any of the poses sets.
+        '''
+        for name in weights:
+            self.check(name, kind)
+        w = np.zeros(len(self.names))
+        for name, weight in weights.items():
+            if weight < 0:
+                raise ValueError("Negative weight {} for pose {!r}".format(weight, name))
+            w[self.index[name]] = weight
+        # per joint, normalized over the poses that set it (unset joints are 0 in self.angles)
+        total = w.dot(self.mask)
+        cols = np.flatnonzero(total > 0)
+        if not len(cols):
+            raise ValueError("Blend {!r} has no positive weight".format(weights))
+        angles = w.dot(self.angles[:, cols]) / total[cols]
+        return [self.joints[col] for col in cols], angles
+
+    def resolve(self, position, kind=None):
+        '''
+        A pose name or a {pose: weight} blend to (joints, angles).
+        '''
+        if isinstance(position, dict):
+            return self.blend(position, kind)
+        return self.lookup(position, kind)
+
+
+def load(joints, path):
+    with open(path) as f:
+        return PoseLibrary(joints, json.load(f, object_pairs_hook=OrderedDict))
@@ -0,0 +1,523 @@
+'''
+Wire format shared by the joystick client (main.py) and the robot server
+(behaviors.py). The robot runs python 2.7, so this module must stay
+compatible with both python 2 and python 3.
+
+Four formats exist:
+
+PROTOCOL_JSON    -- one json.dumps(ev) per line. Spoken by old peers.
+PROTOCOL_BINARY  -- fixed-size little-endian frames:
+                    magic, version, button mask, sequence number,
+                    timestamp, velocity, twist
+PROTOCOL_STAMPED -- binary frames that also carry the input age (time
+                    from the gamepad event to the send, measured on the
+                    client, so no clock sync is needed), plus ping/pong
+                    messages for round-trip times. The magic byte tells
+                    the message types apart.
+PROTOCOL_EVENTS  -- stamped frames plus button presses as events. Every
+                    press is its own message with a per-client id, kept
+                    by the client until the server acknowledges it and
+                    resent after a reconnect; the server drops ids it
+                    has seen. The button bits of frames are ignored.
+
+A new client opens the connection with a hello frame: a regular all-zero
+JSON frame that also carries "max_protocol". Old servers treat it as a
+no-op frame and never answer, so the client falls back to JSON. New
+servers answer with {"protocol": n} and both sides switch to format n.
+
+A client may also ask for the UDP axes channel by adding "udp": 1 to the
+hello. The server then answers with the port to send to, and the client
+streams velocity/twist as small sequence-numbered datagrams there. The
+TCP stream keeps carrying buttons and the emergency stop; its axes are
+ignored while the UDP channel is up. Datagrams that arrive out of order
+are discarded, so a lost packet never holds back newer axis values.
+
+A client on the same host may instead ask for the shared-memory channel
+with "shm": 1 (PROTOCOL_EVENTS only). The server answers with the path of
+a file it created (shm_channel.py); the client writes the axes to it and
+queues its press messages in it, the server acknowledges them over TCP as
+usual. TCP then only carries heartbeats and pings, and its axes are ignored.
+'''
+import json
+import random
+import socket
+import struct
+from collections import deque
+
+AXES = ("velocity", "twist")
+BUTTONS = ("a", "b", "x", "y", "lb", "rb", "info", "start", "center",
+           "left joy button", "right joy button", "up", "down", "left", "right")
+BUTTON_BITS = dict((name, 1 << i) for i, name in enumerate(BUTTONS))
+
+PROTOCOL_JSON = 0
+PROTOCOL_BINARY = 1
+PROTOCOL_STAMPED = 2
+PROTOCOL_EVENTS = 3
+MAX_PROTOCOL = PROTOCOL_EVENTS
+
+FRAME_MAGIC = 0xA5
+PING_MAGIC = 0xA7
+PONG_MAGIC = 0xA8
+PRESS_MAGIC = 0xA9
+ACK_MAGIC = 0xAA
+FRAME_STRUCT = struct.Struct("<BBHIdff")
+STAMPED_FRAME_STRUCT = struct.Struct("<BBHIdffH")
+PING_STRUCT = struct.Struct("<BBId")  # magic, version, ping id, client time
+PONG_STRUCT = struct.Struct("<BBIdd")  # magic, version, ping id, client time, server time
+PRESS_STRUCT = struct.Struct("<BBIBd")  # magic, version, press id, button index, client time
+ACK_STRUCT = struct.Struct("<BBI")  # magic, version, every press id up to this one was received
+# message layouts of each binary protocol, by magic byte
+MESSAGE_STRUCTS = {
+    PROTOCOL_BINARY: {FRAME_MAGIC: FRAME_STRUCT},
+    PROTOCOL_STAMPED: {FRAME_MAGIC: STAMPED_FRAME_STRUCT, PING_MAGIC: PING_STRUCT, PONG_MAGIC: PONG_STRUCT},
+    PROTOCOL_EVENTS: {FRAME_MAGIC: STAMPED_FRAME_STRUCT, PING_MAGIC: PING_STRUCT, PONG_MAGIC: PONG_STRUCT,
+                      PRESS_MAGIC: PRESS_STRUCT, ACK_MAGIC: ACK_STRUCT},
+}
+# first byte of every JSON frame, no binary message starts with it
+JSON_START = ord("{")
+# input age is sent in units of 100 us; this value marks a frame without new input
+NO_INPUT = 0xFFFF
+
+# how long the client waits for the server to answer the hello frame
+HELLO_TIMEOUT = 1.0
+
+# the server stops the base when no frame arrived for WATCHDOG_DEADLINE while
+# driving, and drops the connection after SILENCE_TIMEOUT without any frame.
+# Clients that only send on change must repeat the state more often than that.
+WATCHDOG_DEADLINE = 0.15
+SILENCE_TIMEOUT = 2.0
+DRIVING_HEARTBEAT = WATCHDOG_DEADLINE / 3
+IDLE_HEARTBEAT = 0.5
+
+UDP_PORT = 8889
+AXES_MAGIC = 0xA6
+AXES_STRUCT = struct.Struct("<BBIdff")
+AXES_SIZE = AXES_STRUCT.size
+
+
+def empty_ev():
+    ev = dict((name, 0) for name in BUTTONS)
+    ev["velocity"] = 0.0
+    ev["twist"] = 0.0
+    return ev
+
+
+def encode_json(ev):
+    return (json.dumps(ev) + "\n").encode()
+
+
+def decode_json(line):
+    return json.loads(line)
+
+
+def encode_binary(ev, seq, stamp, input_age=None, version=PROTOCOL_BINARY):
+    mask = 0
+    for name in BUTTONS:
+        if ev[name]:
+            mask |= BUTTON_BITS[name]
+    if version >= PROTOCOL_STAMPED:
+        age = NO_INPUT if input_age is None else min(NO_INPUT - 1, int(input_age * 10000))
+        return STAMPED_FRAME_STRUCT.pack(FRAME_MAGIC, version, mask, seq & 0xFFFFFFFF,
+                                         stamp, ev["velocity"], ev["twist"], age)
+    return FRAME_STRUCT.pack(FRAME_MAGIC, version, mask, seq & 0xFFFFFFFF,
+                             stamp, ev["velocity"], ev["twist"])
+
+
+def decode_binary(buf, offset=0):
+    '''
+    Returns (seq, stamp, ev, input_age) for the frame starting at buf[offset].
+    input_age is None unless the frame is stamped and carries new input.
+    '''
+    magic, version = struct.unpack_from("<BB", buf, offset)
+    if magic != FRAME_MAGIC or version not in MESSAGE_STRUCTS:
+        raise ValueError("Bad frame header {:#x}/{}".format(magic, version))
+    input_age = None
+    if version >= PROTOCOL_STAMPED:
+        _, _, mask, seq, stamp, velocity, twist, age = STAMPED_FRAME_STRUCT.unpack_from(buf, offset)
+        if age != NO_INPUT:
+            input_age = age / 10000.0
+    else:
+        _, _, mask, seq, stamp, velocity, twist = FRAME_STRUCT.unpack_from(buf, offset)
+    ev = dict((name, 1 if mask & BUTTON_BITS[name] else 0) for name in BUTTONS)
+    ev["velocity"] = velocity
+    ev["twist"] = twist
+    return seq, stamp, ev, input_age
+
+
+def encode(protocol, ev, seq, stamp, input_age=None):
+    if protocol == PROTOCOL_JSON:
+        return encode_json(ev)
+    return encode_binary(ev, seq, stamp, input_age, protocol)
+
+
+def message_type(frame):
+    '''
+    Magic byte of a binary message yielded by Framer.frames().
+    '''
+    return struct.unpack_from("<B", frame)[0]
+
+
+def encode_ping(ping_id, stamp):
+    return PING_STRUCT.pack(PING_MAGIC, PROTOCOL_STAMPED, ping_id & 0xFFFFFFFF, stamp)
+
+
+def encode_pong(ping, stamp):
+    '''
+    Answer to a ping message, echoing its id and client time next to our own time.
+    '''
+    _, _, ping_id, client_stamp = PING_STRUCT.unpack_from(ping)
+    return PONG_STRUCT.pack(PONG_MAGIC, PROTOCOL_STAMPED, ping_id, client_stamp, stamp)
+
+
+def decode_pong(pong):
+    '''
+    Returns (ping id, client time, server time).
+    '''
+    _, _, ping_id, client_stamp, server_stamp = PONG_STRUCT.unpack_from(pong)
+    return ping_id, client_stamp, server_stamp
+
+
+def encode_press(press_id, button, stamp):
+    return PRESS_STRUCT.pack(PRESS_MAGIC, PROTOCOL_EVENTS, press_id & 0xFFFFFFFF, BUTTONS.index(button), stamp)
+
+
+def decode_press(press):
+    '''
+    Returns (press id, button name, client time). Raises ValueError on an unknown button.
+    '''
+    _, _, press_id, index, stamp = PRESS_STRUCT.unpack_from(press)
+    if index >= len(BUTTONS):
+        raise ValueError("Bad button index {}".format(index))
+    return press_id, BUTTONS[index], stamp
+
+
+def encode_ack(press_id):
+    return ACK_STRUCT.pack(ACK_MAGIC, PROTOCOL_EVENTS, press_id & 0xFFFFFFFF)
+
+
+def decode_ack(ack):
+    return ACK_STRUCT.unpack_from(ack)[2]
+
+
+###########################
+# Negotiation
+###########################
+def hello(udp=False, session=None, max_protocol=MAX_PROTOCOL, shm=False):
+    ev = empty_ev()
+    ev["max_protocol"] = max_protocol
+    if udp:
+        ev["udp"] = 1
+    if shm:
+        ev["shm"] = 1
+    if session is not None:
+        ev["session"] = session
+    return encode_json(ev)
+
+
+def is_hello(ev):
+    return "max_protocol" in ev
+
+
+def choose_protocol(ev):
+    return min(int(ev["max_protocol"]), MAX_PROTOCOL)
+
+
+def wants_udp(ev):
+    return bool(ev.get("udp"))
+
+
+def wants_shm(ev):
+    return bool(ev.get("shm"))
+
+
+def client_session(ev):
+    return ev.get("session")
+
+
+def accept(protocol, udp_port=None, shm_path=None):
+    reply = {"protocol": protocol}
+    if udp_port is not None:
+        reply["udp_port"] = udp_port
+    if shm_path is not None:
+        reply["shm_path"] = shm_path
+    return (json.dumps(reply) + "\n").encode()
+
+
+def parse_accept(line):
+    '''
+    Returns (protocol, udp_port, shm_path); udp_port and shm_path are None
+    unless the server opened the UDP or shared-memory channel.
+    '''
+    try:
+        reply = json.loads(line)
+        return int(reply["protocol"]), reply.get("udp_port"), reply.get("shm_path")
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return PROTOCOL_JSON, None, None
+
+
+###########################
+# UDP axes channel
+###########################
+def encode_axes(seq, stamp, velocity, twist):
+    return AXES_STRUCT.pack(AXES_MAGIC, PROTOCOL_BINARY, seq & 0xFFFFFFFF, stamp, velocity, twist)
+
+
+def decode_axes(buf):
+    '''
+    Returns (seq, stamp, velocity, twist) of an axes datagram.
+    '''
+    if len(buf) != AXES_SIZE:
+        raise ValueError("Bad axes datagram size {}".format(len(buf)))
+    magic, version, seq, stamp, velocity, twist = AXES_STRUCT.unpack(buf)
+    if magic != AXES_MAGIC or version != PROTOCOL_BINARY:
+        raise ValueError("Bad axes datagram header {:#x}/{}".format(magic, version))
+    return seq, stamp, velocity, twist
+
+
+def seq_newer(seq, last):
+    '''
+    True if seq comes after last, allowing for 32-bit wraparound.
+    '''
+    return last is None or 0 < ((seq - last) & 0xFFFFFFFF) < 0x80000000
+
+
+def tune_socket(sock, keepalive_idle=1, keepalive_interval=1, keepalive_count=3):
+    '''
+    Low-latency settings for a connected control socket: no Nagle delay, and
+    TCP keepalive so a vanished peer is noticed within a few seconds.
+    '''
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # the fine-grained keepalive knobs are Linux only
+    for option, value in (("TCP_KEEPIDLE", keepalive_idle), ("TCP_KEEPINTVL", keepalive_interval),
+                          ("TCP_KEEPCNT", keepalive_count)):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+
+def decode_frame(wire_protocol, frame):
+    '''
+    Decodes one frame yielded by Framer.frames(). Returns (seq, stamp, ev, input_age);
+    JSON frames carry none of them but ev, so the rest are None.
+    Raises ValueError on a malformed frame.
+    '''
+    if wire_protocol != PROTOCOL_JSON:
+        return decode_binary(frame)
+    return None, None, decode_json(frame.tobytes().decode()), None
+
+
+###########################
+# Framing
+###########################
+class Framer(object):
+    '''
+    Incremental framer over one preallocated receive buffer.
+
+    recv_from()/feed() append bytes, frames() yields every complete frame in
+    arrival order as a memoryview into the buffer. Frames are never copied;
+    only a trailing partial frame is moved back to the front of the buffer,
+    and only when the buffer runs out of room. Yielded views are valid until
+    the next recv_from()/feed(), so consume them before reading again.
+
+    The protocol attribute may be switched between frames (e.g. right after
+    the hello frame), the remaining bytes are then framed in the new format.
+    After switch(), a JSON line before the first frame in the new format
+    drops the framer back to PROTOCOL_JSON: the client stopped waiting for
+    the accept and kept speaking JSON.
+    '''
+
+    def __init__(self, wire_protocol=PROTOCOL_JSON, capacity=65536):
+        self.protocol = wire_protocol
+        self.buf = bytearray(capacity)
+        self.start = 0  # first unconsumed byte
+        self.end = 0  # one past the last received byte
+        self.dropped_bytes = 0
+        self.confirmed = True  # False from switch() until a frame arrives in the new format
+
+    def switch(self, wire_protocol):
+        self.protocol = wire_protocol
+        self.confirmed = wire_protocol == PROTOCOL_JSON
+
+    def _reserve(self, n):
+        if self.start == self.end:
+            self.start = self.end = 0
+        if len(self.buf) - self.end >= n:
+            return
+        pending = self.end - self.start
+        self.buf[0:pending] = self.buf[self.start:self.end]
+        self.start, self.end = 0, pending
+        if len(self.buf) - self.end < n:
+            # a single frame larger than the whole buffer can never complete
+            self.dropped_bytes += pending
+            self.start = self.end = 0
+
+    def recv_from(self, sock, max_bytes=4096):
+        '''
+        Reads once from sock into the buffer. Returns the number of bytes read, 0 on EOF.
+        '''
+        self._reserve(max_bytes)
+        n = sock.recv_into(memoryview(self.buf)[self.end:], max_bytes)
+        self.end += n
+        return n
+
+    def feed(self, data):
+        n = len(data)
+        self._reserve(n)
+        if len(self.buf) - self.end < n:
+            raise ValueError("Chunk of {} bytes does not fit into the framer buffer".format(n))
+        self.buf[self.end:self.end + n] = data
+        self.end += n
+
+    def pending(self):
+        return self.end - self.start
+
+    def frames(self):
+        view = memoryview(self.buf)
+        while self.start < self.end:
+            if self.protocol != PROTOCOL_JSON:
+                structs = MESSAGE_STRUCTS[self.protocol]
+                if self.buf[self.start] not in structs:
+                    if not self.confirmed and self.buf[self.start] == JSON_START:
+                        self.protocol = PROTOCOL_JSON
+                        self.confirmed = True
+                        continue
+                    # lost sync, skip ahead to the next possible header
+                    nxt = self.start + 1
+                    while nxt < self.end and self.buf[nxt] not in structs:
+                        nxt += 1
+                    self.dropped_bytes += nxt - self.start
+                    self.start = nxt
+                    continue
+                size = structs[self.buf[self.start]].size
+                if self.end - self.start < size:
+                    return
+                frame = view[self.start:self.start + size]
+                self.start += size
+                self.confirmed = True
+                yield frame
+            else:
+                newline = self.buf.find(b'\n', self.start, self.end)
+                if newline < 0:
+                    return
+                line_start = self.start
+                self.start = newline + 1
+                if newline > line_start:
+                    yield view[line_start:newline]
+
+
+###########################
+# Coalescing
+###########################
+def coalesce(evs):
+    '''
+    Merges frames (oldest first) into one command: buttons are OR-ed, the
+    axes take the latest value, and an emergency stop ("info") wins over
+    everything else, including a later "start" or any axis motion.
+    '''
+    merged = dict(evs[-1])
+    for name in BUTTONS:
+        merged[name] = 1 if any(ev[name] for ev in evs) else 0
+    if merged["info"]:
+        for name in BUTTONS:
+            merged[name] = 0
+        merged["info"] = 1
+        for name in AXES:
+            merged[name] = 0.0
+    return merged
+
+
+###########################
+# Button presses
+###########################
+class PressQueue(object):
+    '''
+    Client side of PROTOCOL_EVENTS. Every press gets the next id and stays
+    queued until the server acknowledges it. take() returns the presses not
+    sent on the current connection, so after a reconnect (resend()) the
+    unacknowledged ones go out again and the server drops any it already has.
+    Not thread-safe, callers hold their own lock.
+    '''
+
+    def __init__(self):
+        # tells the server that ids restart when a new client connects
+        self.session = random.getrandbits(32)
+        self.next_id = 1
+        self.unacked = deque()  # (press id, button, pressed at), oldest first
+        self.unsent = 0  # the newest unsent presses, at the end of unacked
+        self.stats = {"presses": 0, "resent": 0, "acked": 0}
+
+    def press(self, button, now):
+        self.unacked.append((self.next_id, button, now))
+        self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+        self.unsent += 1
+        self.stats["presses"] += 1
+
+    def take(self):
+        '''
+        Encoded presses not sent on this connection yet, marked as sent.
+        '''
+        if not self.unsent:
+            return b''
+        presses = list(self.unacked)[len(self.unacked) - self.unsent:]
+        self.unsent = 0
+        return b''.join(encode_press(press_id, button, stamp) for press_id, button, stamp in presses)
+
+    def unsend(self, count):
+        '''
+        Marks the newest count presses returned by take() as not sent, e.g. when they did not fit.
+        '''
+        self.unsent += count
+
+    def resend(self):
+        '''
+        Call after reconnecting: everything unacknowledged is sent again.
+        '''
+        self.stats["resent"] += len(self.unacked) - self.unsent
+        self.unsent = len(self.unacked)
+
+    def discard(self):
+        '''
+        Forgets every queued press, for servers that only understand button bits.
+        '''
+        self.unacked.clear()
+        self.unsent = 0
+
+    def ack(self, press_id):
+        while len(self.unacked) > self.unsent and not seq_newer(self.unacked[0][0], press_id):
+            self.unacked.popleft()
+            self.stats["acked"] += 1
+
+    def pending(self):
+        return len(self.unacked)
+
+
+class PressFilter(object):
+    '''
+    Server side of PROTOCOL_EVENTS: lets each press id of a client session through once.
+    TCP delivers a session's presses in id order, so the newest id seen is enough.
+    '''
+
+    def __init__(self):
+        self.session = None
+        self.last_id = None
+        self.stats = {"delivered": 0, "duplicates": 0}
+
+    def start(self, session):
+        '''
+        Called on every hello. A new session restarts the ids, a reconnect keeps them.
+        '''
+        if session is None or session != self.session:
+            self.session = session
+            self.last_id = None
+
+    def accept(self, press_id):
+        if not seq_newer(press_id, self.last_id):
+            self.stats["duplicates"] += 1
+            return False
+        self.last_id = press_id
+        self.stats["delivered"] += 1
+        return True
+
+    def report(self):
+        return "presses: {} delivered, {} duplicates dropped".format(
+            self.stats["delivered"], self.stats["duplicates"])
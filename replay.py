@@ -0,0 +1,85 @@
+'''
+Replays a session log recorded with --record into the server.
+
+    python replay.py show.log ROBOT_IP              # in real time
+    python replay.py show.log ROBOT_IP --speed 10   # ten times faster
+    python replay.py show.log localhost --fast      # as fast as the server reads, as a load test
+
+Frames keep their recorded spacing, divided by --speed, and are re-stamped
+and re-sequenced at send time so the server's latency figures stay valid.
+Point it at `python behaviors.py localhost --fake-robot` to replay without a robot.
+'''
+from __future__ import print_function
+import time
+import select
+import argparse
+import protocol
+import session_log
+from socket import socket, AF_INET, SOCK_STREAM
+
+# frames per send() in --fast mode
+FAST_BATCH = 64
+
+
+def connect(ip):
+    s = socket(AF_INET, SOCK_STREAM)
+    s.connect((ip, 8888))
+    protocol.tune_socket(s)
+    # logs hold button bits, not press events
+    s.sendall(protocol.hello(max_protocol=protocol.PROTOCOL_STAMPED))
+    reply = b''
+    deadline = time.time() + protocol.HELLO_TIMEOUT
+    while b'\n' not in reply:
+        remaining = deadline - time.time()
+        read_s, _, _ = select.select([s], [], [], max(0.0, remaining))
+        if not read_s:
+            return s, protocol.PROTOCOL_JSON
+        chunk = s.recv(64)
+        if not chunk:
+            raise IOError("server closed the connection during the handshake")
+        reply += chunk
+    wire_protocol, _, _ = protocol.parse_accept(reply.split(b'\n')[0].decode())
+    return s, wire_protocol
+
+
+def replay(path, ip, speed=1.0, fast=False):
+    s, wire_protocol = connect(ip)
+    total = session_log.count_records(path)
+    print("Replaying {} frames from {} using wire protocol {}".format(total, path, wire_protocol))
+    start = time.time()
+    first = None
+    seq = 0
+    max_lag = 0.0
+    pending = []
+    for logged_at, _, _, ev, input_age in session_log.read_log(path):
+        if first is None:
+            first = logged_at
+        if not fast:
+            due = start + (logged_at - first) / speed
+            wait = due - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            else:
+                max_lag = max(max_lag, -wait)
+        seq += 1
+        pending.append(protocol.encode(wire_protocol, ev, seq, time.time(), input_age))
+        if not fast or len(pending) >= FAST_BATCH:
+            s.sendall(b''.join(pending))
+            pending = []
+    if pending:
+        s.sendall(b''.join(pending))
+    elapsed = time.time() - start
+    s.close()
+    print("Sent {} frames in {:.2f} s ({:,.0f} frames/s), recorded duration {:.2f} s{}".format(
+        seq, elapsed, seq / elapsed if elapsed else 0.0, logged_at - first if first is not None else 0.0,
+        "" if fast else ", max lag behind schedule {:.1f} ms".format(1000 * max_lag)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("log", help="session log written by main.py or behaviors.py with --record")
+    parser.add_argument("ip", help="address of the server")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed, 1 is real time")
+    parser.add_argument("--fast", action="store_true", help="ignore the recorded timing")
+    args = parser.parse_args()
+    replay(args.log, args.ip, args.speed, args.fast)
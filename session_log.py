@@ -0,0 +1,92 @@
+'''
+Compact binary logs of control sessions, for reproducing operator reports
+and for load testing with replay.py. Must stay python 2.7 compatible.
+
+A log is MAGIC followed by fixed-size records: the time the frame was sent
+(client) or received (server) as a little-endian double, then the frame in
+the stamped binary wire format. A record is 34 bytes, so an hour at 20 Hz
+is about 2.4 MB.
+'''
+import mmap
+import time
+import struct
+import threading
+import protocol
+
+MAGIC = b"PJDLOG1\n"
+TIME_STRUCT = struct.Struct("<d")
+RECORD_SIZE = TIME_STRUCT.size + protocol.STAMPED_FRAME_STRUCT.size
+FLUSH_INTERVAL = 1.0
+
+
+class SessionLog(object):
+    '''
+    Appends frames to path. A new file gets the header, an existing log is continued.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.f = open(path, "ab")
+        if self.f.tell() == 0:
+            self.f.write(MAGIC)
+        self.last_flush = time.time()
+        self.records = 0
+
+    def write(self, ev, seq=None, stamp=None, input_age=None, logged_at=None):
+        logged_at = time.time() if logged_at is None else logged_at
+        record = TIME_STRUCT.pack(logged_at) + protocol.encode_binary(
+            ev, seq or 0, stamp or 0.0, input_age, version=protocol.PROTOCOL_STAMPED)
+        with self.lock:
+            if self.f is None:
+                return
+            self.f.write(record)
+            self.records += 1
+            # flush now and then so a crash loses at most the last second
+            if logged_at - self.last_flush >= FLUSH_INTERVAL:
+                self.f.flush()
+                self.last_flush = logged_at
+
+    def flush(self):
+        with self.lock:
+            if self.f is not None:
+                self.f.flush()
+                self.last_flush = time.time()
+
+    def close(self):
+        with self.lock:
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+
+
+def read_log(path):
+    '''
+    Yields (logged_at, seq, stamp, ev, input_age) for every record in the log at path.
+    The file is memory mapped, so logs of any length are read without loading them.
+    '''
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a session log".format(path))
+        f.seek(0, 2)
+        size = f.tell()
+        if size == len(MAGIC):
+            return
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            # a record cut short by a crash is ignored
+            end = len(MAGIC) + (size - len(MAGIC)) // RECORD_SIZE * RECORD_SIZE
+            offset = len(MAGIC)
+            while offset < end:
+                logged_at, = TIME_STRUCT.unpack_from(buf, offset)
+                seq, stamp, ev, input_age = protocol.decode_binary(buf, offset + TIME_STRUCT.size)
+                yield logged_at, seq, stamp, ev, input_age
+                offset += RECORD_SIZE
+        finally:
+            buf.close()
+
+
+def count_records(path):
+    with open(path, "rb") as f:
+        f.seek(0, 2)
+        return max(0, f.tell() - len(MAGIC)) // RECORD_SIZE
@@ -0,0 +1,158 @@
+'''
+Shared-memory channel between a client and a server on the same host. Must stay python 2.7 compatible.
+
+The server creates one page-sized file per connection (in /dev/shm where
+it exists) and sends its path in the handshake, see protocol.py. Both
+sides map it. The client writes, the server reads:
+
+    header  -- magic, layout version
+    axes    -- a seqlock slot: a version that is odd while the client is
+               writing, then seq, stamp, velocity, twist and input age.
+               A read counts only if the version was the same and even
+               before and after the copy, so a torn frame is never used.
+    presses -- a ring of encoded press messages (protocol.encode_press)
+               with a write count, advanced by the client after writing a
+               slot, and a read count, advanced by the server after reading.
+               The client never overwrites a press the server has not read.
+
+Neither side makes a system call per frame; the server polls the slot every
+POLL_INTERVAL. The TCP connection still carries the handshake, heartbeats,
+pings and acknowledgements, and its end tears the channel down. Stores
+become visible in program order on x86, which the seqlock relies on.
+'''
+import os
+import mmap
+import socket
+import struct
+import tempfile
+from protocol import PRESS_STRUCT
+
+MAGIC = b"PJDS"
+LAYOUT_VERSION = 1
+HEADER_STRUCT = struct.Struct("<4sI")
+AXES_OFFSET = 8
+VERSION_STRUCT = struct.Struct("<I")
+AXES_STRUCT = struct.Struct("<Idddd")  # seq, stamp, velocity, twist, input age (negative if none)
+RING_OFFSET = 64
+COUNTS_STRUCT = struct.Struct("<I")  # write count at RING_OFFSET, read count right after
+SLOTS_OFFSET = RING_OFFSET + 8
+RING_CAPACITY = 256
+SIZE = mmap.PAGESIZE * ((SLOTS_OFFSET + RING_CAPACITY * PRESS_STRUCT.size) // mmap.PAGESIZE + 1)
+
+# how often the server looks at the slot, bounds the added latency
+POLL_INTERVAL = 0.001
+
+
+def is_loopback(host):
+    '''
+    True if host resolves to this machine's loopback interface.
+    '''
+    try:
+        return host == "::1" or socket.gethostbyname(host).startswith("127.")
+    except socket.error:
+        return False
+
+
+class ShmChannel(object):
+
+    def __init__(self, path, fd, owner):
+        self.path = path
+        self.owner = owner  # the server, which removes the file
+        self.mm = mmap.mmap(fd, SIZE)
+        os.close(fd)
+        self.version = VERSION_STRUCT.unpack_from(self.mm, AXES_OFFSET)[0]
+        self.write_count = COUNTS_STRUCT.unpack_from(self.mm, RING_OFFSET)[0]
+        self.read_count = COUNTS_STRUCT.unpack_from(self.mm, RING_OFFSET + 4)[0]
+
+    @classmethod
+    def create(cls):
+        directory = "/dev/shm" if os.path.isdir("/dev/shm") else None
+        fd, path = tempfile.mkstemp(prefix="pepper-joystick-", dir=directory)
+        os.ftruncate(fd, SIZE)
+        channel = cls(path, fd, owner=True)
+        HEADER_STRUCT.pack_into(channel.mm, 0, MAGIC, LAYOUT_VERSION)
+        return channel
+
+    @classmethod
+    def open(cls, path):
+        '''
+        Raises IOError (OSError) if the file cannot be mapped, ValueError if it is not a channel.
+        '''
+        fd = os.open(path, os.O_RDWR)
+        if os.fstat(fd).st_size != SIZE:
+            os.close(fd)
+            raise ValueError("{} is not a channel of this layout".format(path))
+        channel = cls(path, fd, owner=False)
+        if HEADER_STRUCT.unpack_from(channel.mm, 0) != (MAGIC, LAYOUT_VERSION):
+            channel.close()
+            raise ValueError("{} is not a channel of this layout".format(path))
+        return channel
+
+    def close(self):
+        self.mm.close()
+        if self.owner:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    ###########################
+    # Client side
+    ###########################
+    def write_axes(self, seq, stamp, velocity, twist, input_age=None):
+        self.version = (self.version + 1) & 0xFFFFFFFF
+        VERSION_STRUCT.pack_into(self.mm, AXES_OFFSET, self.version)
+        AXES_STRUCT.pack_into(self.mm, AXES_OFFSET + 4, seq & 0xFFFFFFFF, stamp, velocity, twist,
+                              -1.0 if input_age is None else input_age)
+        self.version = (self.version + 1) & 0xFFFFFFFF
+        VERSION_STRUCT.pack_into(self.mm, AXES_OFFSET, self.version)
+
+    def push_presses(self, data):
+        '''
+        Writes encoded presses into the ring. Returns the tail of data that did not fit.
+        '''
+        size = PRESS_STRUCT.size
+        read_count = COUNTS_STRUCT.unpack_from(self.mm, RING_OFFSET + 4)[0]
+        offset = 0
+        while offset < len(data) and (self.write_count - read_count) & 0xFFFFFFFF < RING_CAPACITY:
+            slot = SLOTS_OFFSET + (self.write_count % RING_CAPACITY) * size
+            self.mm[slot:slot + size] = data[offset:offset + size]
+            self.write_count = (self.write_count + 1) & 0xFFFFFFFF
+            offset += size
+        if offset:
+            # published after the slots
+            COUNTS_STRUCT.pack_into(self.mm, RING_OFFSET, self.write_count)
+        return data[offset:]
+
+    ###########################
+    # Server side
+    ###########################
+    def read_axes(self, last_version):
+        '''
+        Returns (version, (seq, stamp, velocity, twist, input_age)) if the slot changed
+        since last_version, else None. input_age is None if the frame carries no new input.
+        A slot caught mid-write also returns None, the next poll reads it; spinning
+        would only hold back the writer on a single core.
+        '''
+        version = VERSION_STRUCT.unpack_from(self.mm, AXES_OFFSET)[0]
+        if version == last_version or version & 1:
+            return None
+        seq, stamp, velocity, twist, input_age = AXES_STRUCT.unpack_from(self.mm, AXES_OFFSET + 4)
+        if VERSION_STRUCT.unpack_from(self.mm, AXES_OFFSET)[0] != version:
+            return None
+        return version, (seq, stamp, velocity, twist, None if input_age < 0 else input_age)
+
+    def pop_presses(self):
+        '''
+        Encoded presses written since the last call, oldest first.
+        '''
+        write_count = COUNTS_STRUCT.unpack_from(self.mm, RING_OFFSET)[0]
+        size = PRESS_STRUCT.size
+        presses = []
+        while self.read_count != write_count:
+            slot = SLOTS_OFFSET + (self.read_count % RING_CAPACITY) * size
+            presses.append(self.mm[slot:slot + size])
+            self.read_count = (self.read_count + 1) & 0xFFFFFFFF
+        if presses:
+            COUNTS_STRUCT.pack_into(self.mm, RING_OFFSET + 4, self.read_count)
+        return presses
@@ -0,0 +1,139 @@
+'''
+Telemetry for the robot server, kept off the control path. Must stay python 2.7 compatible.
+
+event() only appends a (time, level, name, message, args) tuple to two
+deques, whose appends are atomic: a fixed-size ring holding the recent
+history at every level, and a bounded queue of the events at or above the
+output level. A writer thread drains the queue every flush_interval and
+does all formatting and stdout writes, so a slow SSH terminal never stalls
+a frame. Per-frame events can be sampled, e.g. {"decider": 20} writes every
+20th "decider" event. Counters are plain named totals.
+
+dump(seconds) returns the last seconds of the ring, debug events included,
+and request_dump has the writer print them, e.g. right after an emergency stop.
+'''
+from __future__ import print_function
+import sys
+import time
+import threading
+import traceback
+from collections import deque
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+OFF = 100  # above every event, nothing is written
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "off": OFF}
+LEVEL_NAMES = dict((value, name.upper()) for name, value in LEVELS.items())
+
+
+def format_event(record):
+    stamp, level, name, message, args = record
+    try:
+        text = message.format(*args)
+    except Exception:
+        text = "{} {!r}".format(message, args)
+    return "{}.{:03d} {:<7} {}: {}".format(
+        time.strftime("%H:%M:%S", time.localtime(stamp)), int(stamp * 1000) % 1000, LEVEL_NAMES[level], name, text)
+
+
+class Telemetry(object):
+
+    def __init__(self, level=INFO, capacity=8192, sample=None, flush_interval=0.1):
+        '''
+        level -- events below it are kept in the ring but not written
+        sample -- {event name: n}, write only every nth event of that name
+        '''
+        self.level = level
+        self.ring = deque(maxlen=capacity)
+        self.pending = deque(maxlen=capacity)
+        self.sample = dict(sample or {})
+        self.sampled = {}  # event name -> events seen by the writer
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()  # counters and dump requests
+        self.counters = {}
+        self.dumps = []  # seconds of history to write, requested by request_dump
+        self.overflows = 0
+        thread = threading.Thread(target=self.loop)
+        thread.daemon = True  # Daemonize thread
+        thread.start()
+
+    def event(self, level, name, message, *args):
+        '''
+        Records an event, message.format(*args) is only evaluated by the writer.
+        '''
+        record = (time.time(), level, name, message, args)
+        self.ring.append(record)
+        if level >= self.level:
+            self.pending.append(record)
+
+    def debug(self, name, message, *args):
+        self.event(DEBUG, name, message, *args)
+
+    def info(self, name, message, *args):
+        self.event(INFO, name, message, *args)
+
+    def warning(self, name, message, *args):
+        self.event(WARNING, name, message, *args)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def dump(self, seconds):
+        '''
+        Lines of the events of the last seconds, at every level.
+        '''
+        since = time.time() - seconds
+        return [format_event(record) for record in list(self.ring) if record[0] >= since]
+
+    def request_dump(self, seconds):
+        '''
+        Has the writer print the last seconds of events. Returns at once.
+        '''
+        with self.lock:
+            self.dumps.append((time.time(), seconds))
+
+    def loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.drain()
+            except Exception:
+                print("Error encountered in telemetry writer.")
+                traceback.print_exc()
+
+    def drain(self):
+        if len(self.pending) == self.pending.maxlen:
+            self.overflows += 1
+        lines = []
+        while self.pending:
+            record = self.pending.popleft()
+            name = record[2]
+            every = self.sample.get(name)
+            if every:
+                seen = self.sampled.get(name, 0)
+                self.sampled[name] = seen + 1
+                if seen % every:
+                    continue
+            lines.append(format_event(record))
+        with self.lock:
+            dumps, self.dumps = self.dumps, []
+        for requested_at, seconds in dumps:
+            since = requested_at - seconds
+            history = [format_event(record) for record in list(self.ring) if since <= record[0] <= requested_at]
+            lines.append("--- last {:.0f} s of telemetry ({} events) ---".format(seconds, len(history)))
+            lines.extend(history)
+            lines.append("--- end of telemetry ---")
+        if lines:
+            # resolved per batch, so redirecting sys.stdout also redirects the writer
+            sys.stdout.write("\n".join(lines) + "\n")
+            sys.stdout.flush()
+
+    def report(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+        parts = ["{} {}".format(name, value) for name, value in counters]
+        if self.overflows:
+            parts.append("writer fell behind {} times".format(self.overflows))
+        return "telemetry: " + (", ".join(parts) if parts else "no counters")
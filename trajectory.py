@@ -0,0 +1,184 @@
+'''
+Keyframe generation for ALMotion.angleInterpolation. Must stay python 2.7 compatible.
+
+Every move eases in and out along the same sigmoid, so the profile for a
+given number of keyframes is computed once and reused. Interpolating any
+number of joints is a single broadcast over a (joints x steps) array,
+converted to python lists only once for the qi call.
+
+With a max_deviation bound, each joint gets only as many keyframes as it
+needs: the fewest samples of the same sigmoid whose piecewise-linear path
+stays within max_deviation of the full curve, capped at one keyframe per
+motion cycle. A joint that barely moves gets a single keyframe.
+'''
+import numpy as np
+
+TIME_DIVIDOR = 100
+# ALMotion runs a 10 ms control cycle, denser keyframes are wasted
+MOTION_CYCLE = 0.01
+
+_sigmoid_profiles = {}
+_time_profiles = {}
+_sampled_profiles = {}
+_sampling_errors = {}
+
+
+def sigmoid_profile(steps):
+    '''
+    Interpolation weights in (0, 1) for steps keyframes, cached per step count.
+    '''
+    profile = _sigmoid_profiles.get(steps)
+    if profile is None:
+        profile = 1 / (1 + np.exp(-np.linspace(-6, 6, steps)))
+        profile.flags.writeable = False
+        _sigmoid_profiles[steps] = profile
+    return profile
+
+
+def time_profile(steps):
+    '''
+    Keyframe times as fractions of the move duration: 1/steps, 2/steps, ..., 1.
+    '''
+    profile = _time_profiles.get(steps)
+    if profile is None:
+        profile = np.arange(1, steps + 1) / float(steps)
+        profile.flags.writeable = False
+        _time_profiles[steps] = profile
+    return profile
+
+
+def sampled_profile(keyframes, steps=TIME_DIVIDOR):
+    '''
+    (time fractions, weights) of keyframes roughly evenly spaced samples of the
+    steps-keyframe profile, always ending on its last keyframe.
+    '''
+    key = (keyframes, steps)
+    profile = _sampled_profiles.get(key)
+    if profile is None:
+        indices = np.arange(1, keyframes + 1) * steps // keyframes - 1
+        profile = (time_profile(steps)[indices], sigmoid_profile(steps)[indices])
+        _sampled_profiles[key] = profile
+    return profile
+
+
+def sampling_errors(steps=TIME_DIVIDOR):
+    '''
+    errors[k - 1] bounds the deviation, for a unit move, of the piecewise-linear
+    path through k sampled keyframes from the full steps-keyframe profile.
+    '''
+    errors = _sampling_errors.get(steps)
+    if errors is None:
+        dense_t = np.concatenate(([0.0], time_profile(steps)))
+        dense = np.concatenate(([0.0], sigmoid_profile(steps)))
+        errors = np.empty(steps)
+        for k in range(1, steps + 1):
+            t, w = sampled_profile(k, steps)
+            path = np.interp(dense_t, np.concatenate(([0.0], t)), np.concatenate(([0.0], w)))
+            errors[k - 1] = np.abs(path - dense).max()
+        # take the worst error of any larger k so the array is non-increasing
+        errors = np.maximum.accumulate(errors[::-1])[::-1]
+        errors.flags.writeable = False
+        _sampling_errors[steps] = errors
+    return errors
+
+
+def keyframe_counts(distances, seconds, max_deviation, steps=TIME_DIVIDOR):
+    '''
+    Fewest keyframes per joint that keep each joint within max_deviation of the full profile.
+    '''
+    errors = sampling_errors(steps)
+    # errors is non-increasing, so search the negated array
+    counts = np.searchsorted(-errors, -max_deviation / np.maximum(distances, 1e-12)) + 1
+    cap = max(1, min(steps, int(seconds / MOTION_CYCLE)))
+    return np.minimum(counts, cap)
+
+
+def interpolate(start_angles, target_angles, seconds, steps=TIME_DIVIDOR, max_deviation=None):
+    '''
+    Returns (times, angles) lists ready for angleInterpolation, one row per joint.
+    Without max_deviation every joint gets steps keyframes, otherwise see keyframe_counts.
+    '''
+    start = np.asarray(start_angles, dtype=float)[:, np.newaxis]
+    end = np.asarray(target_angles, dtype=float)[:, np.newaxis]
+    if max_deviation is None:
+        angles = start + (end - start) * sigmoid_profile(steps)
+        times = (seconds * time_profile(steps)).tolist()
+        return [times] * len(angles), angles.tolist()
+
+    counts = keyframe_counts(np.abs(end - start)[:, 0], seconds, max_deviation, steps)
+    times = [None] * len(counts)
+    angles = [None] * len(counts)
+    # one broadcast per distinct keyframe count
+    for k in np.unique(counts):
+        rows = np.flatnonzero(counts == k)
+        fractions, weights = sampled_profile(k, steps)
+        group_times = (seconds * fractions).tolist()
+        group_angles = (start[rows] + (end[rows] - start[rows]) * weights).tolist()
+        for row, row_angles in zip(rows, group_angles):
+            times[row] = group_times
+            angles[row] = row_angles
+    return times, angles
+
+
+class Trajectory(object):
+    '''
+    Compiles consecutive moves into one keyframe list per joint, so a whole
+    multi-waypoint animation goes out in a single angleInterpolation call.
+
+        traj = Trajectory(names, current_angles)
+        traj.move([a, b], 2.0)
+        traj.move([c], 1.0, joints=["HeadYaw"])
+        names, angles, times = traj.compile()
+    '''
+
+    def __init__(self, joints, start_angles, steps=TIME_DIVIDOR, max_deviation=None):
+        self.joints = list(joints)
+        self.index = dict((joint, i) for i, joint in enumerate(self.joints))
+        self.angles = [float(angle) for angle in start_angles]
+        self.steps = steps
+        self.max_deviation = max_deviation
+        self.times = [[] for _ in self.joints]
+        self.keyframes = [[] for _ in self.joints]
+        self.duration = 0.0
+
+    def move(self, target_angles, seconds, joints=None):
+        '''
+        Appends a sigmoid move of joints (default: all) to target_angles, starting
+        where the previous move ended. The other joints hold their angle.
+        '''
+        rows = range(len(self.joints)) if joints is None else [self.index[joint] for joint in joints]
+        starts = [self.angles[row] for row in rows]
+        times, angles = interpolate(starts, target_angles, seconds, self.steps, self.max_deviation)
+        moving = set()
+        for row, row_times, row_angles in zip(rows, times, angles):
+            self.times[row].extend([self.duration + t for t in row_times])
+            self.keyframes[row].extend(row_angles)
+            self.angles[row] = row_angles[-1]
+            moving.add(row)
+        self.duration += seconds
+        self.hold(exclude=moving)
+        return self
+
+    def wait(self, seconds):
+        self.duration += seconds
+        self.hold()
+        return self
+
+    def hold(self, exclude=()):
+        '''
+        Pins joints at their current angle at the end of the trajectory so far,
+        otherwise ALMotion would interpolate them towards their next keyframe.
+        '''
+        for row in range(len(self.joints)):
+            if row not in exclude and (not self.times[row] or self.times[row][-1] < self.duration):
+                self.times[row].append(self.duration)
+                self.keyframes[row].append(self.angles[row])
+
+    def compile(self):
+        '''
+        Returns (names, angles, times) for angleInterpolation. Joints without keyframes are left out.
+        '''
+        rows = [row for row in range(len(self.joints)) if self.times[row]]
+        return ([self.joints[row] for row in rows],
+                [self.keyframes[row] for row in rows],
+                [self.times[row] for row in rows])